@@ -12,7 +12,9 @@ from common import pattern
 from flightdata import readers
 from flightdata import writers
 from flightdata import definitions
+from onelog.core import analysis_cache
 from onelog.core import essential
+from onelog.core import flight_storage
 from onelog.core import models
 from onelog.core import engine
 
@@ -55,9 +57,16 @@ class LogEntry(flask_restful.Resource):
     log.save()
 
   def put(self):
-    data = flask.request.get_json()
-    log = models.LogEntry.objects.from_json(data)
-    log.update()
+    data = flask.request.data
+    log = models.LogEntry.from_json(data, created=True)
+    original = models.LogEntry.objects(id=log.id).first()
+    if not original:
+      flask_restful.abort(404)
+
+    compute_engine = engine.ComputeEngine()
+    compute_engine.recompute(log, engine.get_user_changes(original, log))
+    log.last_modified_at = datetime.datetime.utcnow()
+    log.save()
 
   def delete(self):
     data = flask.request.get_json()
@@ -89,12 +98,15 @@ class Aircraft(flask_restful.Resource):
     return flask.Response(data, status=200, mimetype='application/json')
 
 
-def _process_flight_data(flight_id, components):
+def _get_flight_data(flight_id):
   flight_data = models.FlightData.objects(flight_id=flight_id).first()
   if not flight_data:
     raise Exception('Flight data not found.')
+  return flight_data
 
-  stream = io.BytesIO(flight_data.data)
+
+def _process_flight_data(flight_data, components):
+  stream = flight_storage.open_stream(flight_data)
   reader = readers.CompressedFlightDataReader(stream)
   components = [
       readers.FlightDataAggregator(),
@@ -113,14 +125,21 @@ def _process_flight_data(flight_id, components):
 class FlightData(flask_restful.Resource):
   def get(self, flight_id):
     try:
-      data = []
-      _process_flight_data(flight_id, [_GpsDataExtractor(data)])
+      flight_data = _get_flight_data(flight_id)
+      data = analysis_cache.get_track(
+          flight_data, lambda: _extract_gps_data(flight_data))
       return flask.Response(
           json.dumps(data), status=200, mimetype='application/json')
     except:
       return ''
 
 
+def _extract_gps_data(flight_data):
+  data = []
+  _process_flight_data(flight_data, [_GpsDataExtractor(data)])
+  return data
+
+
 class _GpsDataExtractor(object):
   _THRESHOLD = 0.00001
 
@@ -153,8 +172,14 @@ class _GpsDataExtractor(object):
 
 class KmlFile(flask_restful.Resource):
   def get(self, flight_id):
-    stream = io.BytesIO()
-    _process_flight_data(flight_id, [writers.KmlWriter(stream)])
-    response = flask.make_response(stream.getvalue())
+    flight_data = _get_flight_data(flight_id)
+    kml = analysis_cache.get_kml(flight_data,
+                                 lambda: self._write_kml(flight_data))
+    response = flask.make_response(kml)
     response.headers["Content-Disposition"] = "attachment; filename=flight.kml"
-    return response
\ No newline at end of file
+    return response
+
+  def _write_kml(self, flight_data):
+    stream = io.BytesIO()
+    _process_flight_data(flight_data, [writers.KmlWriter(stream)])
+    return stream.getvalue()
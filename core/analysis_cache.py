@@ -0,0 +1,137 @@
+import datetime
+import zlib
+
+from onelog.core import analyzer
+from onelog.core import engine
+from onelog.core import essential
+from onelog.core import flight_storage
+from onelog.core import models
+from onelog.util import cache
+
+# Results above this size are recomputed rather than stored, to stay well
+# below the 16MB document limit.
+_MAX_RESULT_BYTES = 4 * 1024 * 1024
+
+# (content hash, analyzer version) -> FlightAnalysis or None
+_analyses = cache.LruCache('flight_analysis', max_size=64)
+
+
+def _is_complete(flight_data):
+  return (flight_data.status == models.FlightDataStatus.UPLOADED and
+          flight_data.next_index == -1)
+
+
+def get_key(flight_data):
+  """Returns the cache key of a completely uploaded flight, or None.
+
+  Flights uploaded before content hashes existed get theirs on first use.
+  """
+  if not _is_complete(flight_data):
+    return None
+  if not flight_data.content_hash:
+    flight_data.content_hash = flight_storage.get_content_hash(
+        flight_storage.iter_chunks(flight_data))
+    models.FlightData.objects(id=flight_data.id).update_one(
+        set__content_hash=flight_data.content_hash)
+  return (flight_data.content_hash, analyzer.VERSION)
+
+
+def _load(key):
+  return models.FlightAnalysis.objects(
+      content_hash=key[0], analyzer_version=key[1]).first()
+
+
+def _store(key, **kwargs):
+  update = dict(('set__' + name, value) for name, value in kwargs.items())
+  models.FlightAnalysis.objects(
+      content_hash=key[0], analyzer_version=key[1]).update_one(
+          upsert=True,
+          set_on_insert__created_at=datetime.datetime.utcnow(),
+          **update)
+  _analyses.invalidate(key)
+
+
+def _get(key):
+  return _analyses.get(key, _load)
+
+
+def get_log_entry(flight_data, analyze):
+  """Returns a new log entry for a flight, analyzing it only on cache miss.
+
+  Only fields recorded from the flight data are cached. Derived fields are
+  computed on every hit, so they follow changes to compute rules and
+  reference data.
+
+  Args:
+    analyze: Callable returning a freshly analyzed log entry.
+  """
+  key = get_key(flight_data)
+  analysis = _get(key) if key else None
+  if not analysis or not analysis.data_fields:
+    log_entry = analyze()
+    if key:
+      _store(key, data_fields=_copy_recorded_fields(log_entry.data_fields))
+    return log_entry
+
+  log_entry = models.LogEntry()
+  log_entry.data_fields = _copy_recorded_fields(analysis.data_fields)
+  engine.ComputeEngine().compute(log_entry)
+  log_entry.type = models.LogEntryType.FLIGHT
+  log_entry.timestamp = log_entry.get_field_value(essential.TimeOut.id())
+  log_entry.flight_id = flight_data.flight_id
+  log_entry.created_at = datetime.datetime.now()
+  log_entry.last_modified_at = log_entry.created_at
+  return log_entry
+
+
+def get_track(flight_data, extract):
+  """Returns the processed track of a flight.
+
+  Args:
+    extract: Callable returning the track as a list of
+      [seconds since epoch, latitude, longitude, altitude in feet].
+  """
+  key = get_key(flight_data)
+  analysis = _get(key) if key else None
+  if analysis and analysis.track:
+    return analysis.track
+
+  track = extract()
+  # A BSON array of four doubles takes about 60 bytes.
+  if key and len(track) * 60 < _MAX_RESULT_BYTES:
+    _store(key, track=track)
+  return track
+
+
+def get_kml(flight_data, write):
+  """Returns the KML of a flight.
+
+  Args:
+    write: Callable returning the KML document as a string.
+  """
+  key = get_key(flight_data)
+  analysis = _get(key) if key else None
+  if analysis and analysis.kml:
+    return zlib.decompress(analysis.kml)
+
+  kml = write()
+  compressed = zlib.compress(kml)
+  if key and len(compressed) < _MAX_RESULT_BYTES:
+    _store(key, kml=compressed)
+  return kml
+
+
+def _copy_recorded_fields(data_fields):
+  return [_copy_field(x) for x in data_fields if not x.derived]
+
+
+def _copy_field(field):
+  return models.LogEntryField(
+      type_id=field.type_id,
+      raw_value=field.raw_value,
+      airman_id=field.airman_id,
+      derived=field.derived)
+
+
+def get_stats():
+  return _analyses.get_stats()
@@ -1,6 +1,7 @@
+import collections
 import datetime
 import geopy
-import io
+import threading
 
 from common import pattern
 from common import unit
@@ -8,59 +9,280 @@ from flightdata import readers
 from flightdata import definitions
 from onelog.core import engine
 from onelog.core import essential
+from onelog.core import flight_storage
 from onelog.core import models
+from onelog.core import profiling
+from onelog.core import reference
+
+try:
+  from onelog.core import columnar
+except ImportError:
+  columnar = None
+
+# Bump whenever analysis results change, so cached analyses (see
+# core/analysis_cache.py) are recomputed.
+VERSION = 1
+
+# Shared field types an analysis fills in from the recorded data. Re-analyzing
+# a flight replaces these; see tools/reanalyze.py.
+RECORDED_FIELD_TYPES = (
+    essential.DepartureAirport,
+    essential.ArrivalAirport,
+    essential.Route,
+    essential.DayLanding,
+    essential.TimeOut,
+    essential.TimeIn,
+)
 
 
 class FlightDataAnalyzer(pattern.Logger):
+  """Derives a log entry from recorded flight data.
 
-  def __init__(self, *args, **kwargs):
+  By default samples flow one at a time through a chain of processors. With
+  vectorized=True they are decoded into numpy arrays once and every detector
+  runs as a vectorized pass over the whole flight instead (needs numpy).
+
+  With profile=True every session measures its stages (see
+  AnalysisSession.profiler). dump_path adds a debug sink that writes every
+  sample to that file.
+  """
+
+  def __init__(self, vectorized=False, profile=False, dump_path=None, *args,
+               **kwargs):
     super(FlightDataAnalyzer, self).__init__(*args, **kwargs)
+    if vectorized and not columnar:
+      raise Exception('Vectorized analysis requires numpy.')
+    self._vectorized = vectorized
+    self._profile = profile
+    self._dump_path = dump_path
+
+  def start(self, flight_id):
+    """Returns a session to be fed the flight data chunk by chunk."""
+    return AnalysisSession(
+        flight_id,
+        vectorized=self._vectorized,
+        profiler=profiling.PipelineProfiler() if self._profile else None,
+        dump_path=self._dump_path)
 
   def analyze(self, flight_data):
-    self.logger.info('Analyzing flight {0}...'.format(flight_data.flight_id))
+    session = self.start(flight_data.flight_id)
+    for data in flight_storage.iter_chunks(flight_data):
+      session.feed(data)
+    log_entry = session.finish()
+    if session.profiler:
+      self.logger.info('Analysis profile of flight {0}:\n{1}'.format(
+          flight_data.flight_id, session.profiler.format_report()))
+    return log_entry
 
-    stream = io.BytesIO(flight_data.data)
-    reader = readers.CompressedFlightDataReader(stream)
-    log_entry = models.LogEntry()
-    log_entry.add_field(essential.TailNumber, 'N2112K')
-
-    processors = [
-        readers.FlightDataAggregator(),
-        readers.FlightDataCorrector(),
-        NearbyAirportMarker(),
-        StopMarker(),
-        DepartureAirportDetector(log_entry),
-        ArrivalAirportDetector(log_entry),
-        RouteDetector(log_entry),
-        LandingsDetector(log_entry),
-        InOutTimeDetector(log_entry),
-        Dump(),
+  def _on_data(self, timestamp, datum):
+    for data_type in datum:
+      value = datum[data_type]
+      self.logger.debug('{0}: {1}={2}'.format(timestamp, data_type.name,
+                                              data_type.normalize(value)))
+
+
+class AnalysisSession(pattern.Logger):
+  """Incremental analysis of one flight.
+
+  Processors are kept alive between chunks, so departure airport, route,
+  landings and in/out time build up while the flight is still uploading and
+  finish() only has to flush them. Chunks are decoded as one continuous stream
+  by a thread of the session, so they may split records anywhere. A session
+  that is not finished must be close()d to stop that thread.
+
+  With a profiler, samples in/out, wall time and DB queries are recorded for
+  decoding, each processor, the vectorized passes and the compute engine.
+  """
+
+  def __init__(self, flight_id, vectorized=False, profiler=None,
+               dump_path=None, *args, **kwargs):
+    super(AnalysisSession, self).__init__(*args, **kwargs)
+    self._flight_id = flight_id
+    self._profiler = profiler
+    self._decode = self._instrument('(decode)', lambda reader: reader.read())
+    self._log_entry = models.LogEntry()
+    self._log_entry.add_field(essential.TailNumber, 'N2112K')
+    self._track = columnar.FlightTrack() if vectorized else None
+    if self._track is not None:
+      self._processors = [
+          readers.FlightDataAggregator(),
+          readers.FlightDataCorrector(),
+          self._track,
+      ]
+    else:
+      self._processors = [
+          readers.FlightDataAggregator(),
+          readers.FlightDataCorrector(),
+          NearbyAirportMarker(reference.get_airport_index()),
+          StopMarker(),
+          DepartureAirportDetector(self._log_entry),
+          ArrivalAirportDetector(self._log_entry),
+          RouteDetector(self._log_entry),
+          LandingsDetector(self._log_entry),
+          InOutTimeDetector(self._log_entry),
+      ]
+    if dump_path:
+      # The track collects samples rather than passing them on.
+      position = -1 if self._track is not None else len(self._processors)
+      self._processors.insert(position, Dump(dump_path))
+
+    self._inputs = [
+        self._instrument(type(x).__name__, x.on_data) for x in self._processors
     ]
-    prev = reader
-    for processor in processors:
-      prev.on('data', processor.on_data)
-      prev = processor
-    reader.read()
-    for processor in processors:
+    for i, processor in enumerate(self._processors):
+      downstream = self._inputs[i + 1] if i + 1 < len(self._inputs) else None
+      output = self._output(type(processor).__name__, downstream)
+      if output and hasattr(processor, 'on'):
+        processor.on('data', output)
+    self._chunks = 0
+    self._finished = False
+    # Started on the first chunk.
+    self._pending_chunks = None
+    self._decoder = None
+    self._decode_error = None
+
+  @property
+  def flight_id(self):
+    return self._flight_id
+
+  @property
+  def chunks(self):
+    return self._chunks
+
+  @property
+  def profiler(self):
+    return self._profiler
+
+  def _instrument(self, name, func):
+    return self._profiler.wrap(name, func) if self._profiler else func
+
+  def _output(self, name, downstream):
+    if not self._profiler:
+      return downstream
+
+    def on_output(timestamp, datum):
+      self._profiler.count_output(name)
+      if downstream:
+        downstream(timestamp, datum)
+
+    return on_output
+
+  def feed(self, data):
+    """Queues the next chunk of the flight data for decoding.
+
+    Raises:
+      Exception: The session is finished, or decoding earlier chunks failed.
+    """
+    if self._finished:
+      raise Exception('Analysis of flight {0} is already finished.'.format(
+          self._flight_id))
+    if self._decode_error:
+      raise Exception('Failed to decode flight {0}: {1}'.format(
+          self._flight_id, self._decode_error))
+
+    if not self._decoder:
+      self._start_decoder()
+    self._pending_chunks.put(data)
+    self._chunks += 1
+
+  def close(self):
+    """Discards the session, stopping its decoder without waiting for it."""
+    self._finished = True
+    if self._pending_chunks:
+      self._pending_chunks.close(discard=True)
+
+  def _start_decoder(self):
+    self._pending_chunks = _ChunkQueue()
+    # Waiting for the upload is charged to its own stage, not to decoding.
+    get_chunk = self._instrument('(wait for chunk)', self._pending_chunks.get)
+    # The total size is not known while uploading.
+    stream = flight_storage.FlightDataStream(iter(get_chunk, None), 0)
+    self._decoder = threading.Thread(
+        target=self._run_decoder,
+        args=(stream,),
+        name='analyze-{0}'.format(self._flight_id))
+    self._decoder.daemon = True
+    self._decoder.start()
+
+  def _run_decoder(self, stream):
+    reader = readers.CompressedFlightDataReader(stream)
+    reader.on('data', self._output('(decode)', self._inputs[0]))
+    try:
+      self._decode(reader)
+    except Exception as e:
+      self._decode_error = e
+      if not self._pending_chunks.discarded:
+        self.logger.exception('Failed to decode flight {0}.'.format(
+            self._flight_id))
+
+  def finish(self):
+    """Decodes the remaining chunks and returns the log entry.
+
+    Raises:
+      Exception: Decoding failed.
+    """
+    self.logger.info('Analyzing flight {0}...'.format(self._flight_id))
+    self._finished = True
+    if self._decoder:
+      self._pending_chunks.close()
+      self._decoder.join()
+    if self._decode_error:
+      raise Exception('Failed to decode flight {0}: {1}'.format(
+          self._flight_id, self._decode_error))
+    for processor in self._processors:
       if isinstance(processor, DataProcessor):
         processor.done()
+    if self._track is not None:
+      self._instrument('(vectorized)', columnar.analyze)(
+          self._track.finish(), self._log_entry, reference.get_airport_index(),
+          NearbyAirportMarker._MAX_DISTANCE)
 
+    log_entry = self._log_entry
     compute_engine = engine.ComputeEngine()
-    compute_engine.compute(log_entry)
+    self._instrument('(compute)', compute_engine.compute)(log_entry)
 
     log_entry.type = models.LogEntryType.FLIGHT
     log_entry.timestamp = log_entry.get_field_value(essential.TimeOut.id())
-    log_entry.flight_id = flight_data.flight_id
+    log_entry.flight_id = self._flight_id
     log_entry.created_at = datetime.datetime.now()
     log_entry.last_modified_at = log_entry.created_at
 
     return log_entry
 
-  def _on_data(self, timestamp, datum):
-    for data_type in datum:
-      value = datum[data_type]
-      self.logger.debug('{0}: {1}={2}'.format(timestamp, data_type.name,
-                                              data_type.normalize(value)))
+
+class _ChunkQueue(object):
+  """Hands uploaded chunks to the thread decoding them."""
+
+  def __init__(self):
+    self._chunks = collections.deque()
+    self._closed = False
+    self._discarded = False
+    self._condition = threading.Condition()
+
+  @property
+  def discarded(self):
+    return self._discarded
+
+  def put(self, data):
+    with self._condition:
+      self._chunks.append(data)
+      self._condition.notify()
+
+  def close(self, discard=False):
+    """Ends the stream after the queued chunks, or right away if discard."""
+    with self._condition:
+      self._closed = True
+      if discard:
+        self._discarded = True
+        self._chunks.clear()
+      self._condition.notify()
+
+  def get(self):
+    """Returns the next chunk, waiting for one; None at the end."""
+    with self._condition:
+      while not self._chunks and not self._closed:
+        self._condition.wait()
+      return self._chunks.popleft() if self._chunks else None
 
 
 class DataProcessor(object):
@@ -73,9 +295,12 @@ class NearbyAirportMarker(DataProcessor, pattern.EventEmitter):
 
   _DISTANCE_THRESHOLD = unit.Length(2, unit.Length.STATUTE_MILE)
   _MILE_TO_DEGREE = 1 / 3963.2
+  # $maxDistance of a $near query on a GeoJSON point is in meters.
+  _MAX_DISTANCE = _DISTANCE_THRESHOLD.sm / _MILE_TO_DEGREE
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self, airport_index=None, *args, **kwargs):
     super(NearbyAirportMarker, self).__init__(*args, **kwargs)
+    self._airport_index = airport_index
     self._last_position = None
     self._last_airport = None
 
@@ -95,10 +320,13 @@ class NearbyAirportMarker(DataProcessor, pattern.EventEmitter):
         self.emit('data', timestamp, datum)
         return
 
-    self._last_airport = models.Airport.objects(
-        location__near=[lon.degree, lat.degree],
-        location__max_distance=NearbyAirportMarker._DISTANCE_THRESHOLD.sm /
-        NearbyAirportMarker._MILE_TO_DEGREE).first()
+    if self._airport_index is not None:
+      self._last_airport = self._airport_index.nearest(
+          lon.degree, lat.degree, NearbyAirportMarker._MAX_DISTANCE)
+    else:
+      self._last_airport = models.Airport.objects(
+          location__near=[lon.degree, lat.degree],
+          location__max_distance=NearbyAirportMarker._MAX_DISTANCE).first()
 
     if self._last_airport:
       datum['nearby_airport'] = self._last_airport
@@ -228,11 +456,12 @@ class InOutTimeDetector(DataProcessor, pattern.EventEmitter):
       self._log_entry.add_field(essential.TimeIn, self._end_time)
 
 
-class Dump(DataProcessor, pattern.Logger):
+class Dump(DataProcessor, pattern.EventEmitter):
+  """Debug stage writing every sample that passes through to a file."""
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self, path='dump.txt', *args, **kwargs):
     super(Dump, self).__init__(*args, **kwargs)
-    self._file = open('dump.txt', 'w')
+    self._file = open(path, 'w')
 
   def on_data(self, timestamp, datum):
     speed = datum[
@@ -245,12 +474,15 @@ class Dump(DataProcessor, pattern.Logger):
     airport = datum['airport'].icao_id if 'airport' in datum else '-'
     self._file.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(
         timestamp, speed, alt, nearby_airport, airport))
+    self.emit('data', timestamp, datum)
 
   def done(self):
     self._file.close()
 
 
 if __name__ == '__main__':
+  profiling.install()
   flight_data = models.FlightData.objects().first()
-  log_entry = FlightDataAnalyzer().analyze(flight_data)
+  log_entry = FlightDataAnalyzer(profile=True, dump_path='dump.txt').analyze(
+      flight_data)
   print repr(log_entry)
@@ -0,0 +1,188 @@
+import collections
+import threading
+
+from pymongo import errors
+
+from common import pattern
+from onelog.core import profiling
+
+
+class _PendingWrite(object):
+
+  def __init__(self):
+    self.error = None
+    self.done = threading.Event()
+
+
+class BulkWriter(pattern.Logger):
+  """Buffers documents of a collection and inserts them in batches.
+
+  Writer threads flush with an unordered insert_many as soon as `batch_size`
+  documents are queued or the oldest one has waited `flush_interval` seconds.
+  """
+
+  # Number of recent batches kept for latency percentiles.
+  LATENCY_WINDOW = 1000
+
+  def __init__(self, document_cls, batch_size=500, flush_interval=0.2,
+               writers=1, max_queue_size=None, prepare=None, *args, **kwargs):
+    """Creates a stopped writer.
+
+    Args:
+      writers: Number of threads inserting batches concurrently.
+      max_queue_size: write() blocks while this many documents are queued.
+        Unbounded if not set.
+      prepare: Called with each batch of documents before it is inserted,
+        one batch at a time.
+    """
+    super(BulkWriter, self).__init__(*args, **kwargs)
+    self._document_cls = document_cls
+    self._batch_size = batch_size
+    self._flush_interval = flush_interval
+    self._writers = writers
+    self._max_queue_size = max_queue_size
+    self._prepare = prepare
+    self._prepare_lock = threading.Lock()
+    self._queue = collections.deque()
+    lock = threading.Lock()
+    self._condition = threading.Condition(lock)
+    self._not_full = threading.Condition(lock)
+    self._stopped = False
+    self._threads = []
+
+    self._max_queue_depth = 0
+    self._written = 0
+    self._failed = 0
+    self._batches = 0
+    self._flush_seconds = 0.0
+    self._latencies = collections.deque(maxlen=BulkWriter.LATENCY_WINDOW)
+
+  def start(self):
+    self._stopped = False
+    for i in range(self._writers):
+      thread = threading.Thread(
+          target=self._run, name='bulk-writer-{0}-{1}'.format(
+              self._document_cls.__name__, i))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def stop(self):
+    """Flushes everything queued so far and stops the writer threads."""
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+      self._not_full.notify_all()
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  def write(self, document, wait=False):
+    """Queues a document.
+
+    Blocks while the queue is full.
+
+    Args:
+      document: A Document, or a dict already in its stored form.
+      wait: Whether to block until the document's batch is written.
+
+    Returns:
+      None if not waiting or written, otherwise the write error.
+    """
+    pending = _PendingWrite() if wait else None
+    with self._condition:
+      while (self._max_queue_size and not self._stopped and
+             len(self._queue) >= self._max_queue_size):
+        self._not_full.wait()
+      if self._stopped:
+        raise Exception('Writer of {0} is stopped.'.format(
+            self._document_cls.__name__))
+      self._queue.append((profiling.timer(), document, pending))
+      self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+      # Wake a writer to start the flush timer, or to flush a full batch.
+      if len(self._queue) == 1 or len(self._queue) % self._batch_size == 0:
+        self._condition.notify()
+    if not wait:
+      return None
+    pending.done.wait()
+    return pending.error
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._stopped and not self._is_due():
+          if self._queue:
+            self._condition.wait(self._queue[0][0] + self._flush_interval -
+                                 profiling.timer())
+          else:
+            self._condition.wait()
+        if self._stopped and not self._queue:
+          return
+        batch = [
+            self._queue.popleft()
+            for _ in range(min(self._batch_size, len(self._queue)))
+        ]
+        self._not_full.notify_all()
+        # Let another writer take the next batch while this one is inserted.
+        if self._is_due():
+          self._condition.notify()
+      self._flush([x[1] for x in batch], [x[2] for x in batch])
+
+  def _is_due(self):
+    return self._queue and (
+        len(self._queue) >= self._batch_size or
+        profiling.timer() - self._queue[0][0] >= self._flush_interval)
+
+  def _flush(self, documents, pendings):
+    start = profiling.timer()
+    failed = {}
+    try:
+      if self._prepare:
+        with self._prepare_lock:
+          self._prepare(documents)
+      self._document_cls._get_collection().insert_many(
+          [x if isinstance(x, dict) else x.to_mongo() for x in documents],
+          ordered=False)
+    except errors.BulkWriteError as e:
+      for error in e.details.get('writeErrors', []):
+        failed[error['index']] = error.get('errmsg')
+    except Exception as e:
+      self.logger.exception('Failed to write {0} {1} documents.'.format(
+          len(documents), self._document_cls.__name__))
+      failed = dict((i, str(e)) for i in range(len(documents)))
+    seconds = profiling.timer() - start
+
+    for i, pending in enumerate(pendings):
+      if pending:
+        pending.error = failed.get(i)
+        pending.done.set()
+    with self._condition:
+      self._batches += 1
+      self._written += len(documents) - len(failed)
+      self._failed += len(failed)
+      self._flush_seconds += seconds
+      self._latencies.append(seconds)
+
+  def get_stats(self):
+    with self._condition:
+      latencies = sorted(self._latencies)
+      return {
+          'name': self._document_cls.__name__,
+          'queue_depth': len(self._queue),
+          'max_queue_depth': self._max_queue_depth,
+          'written': self._written,
+          'failed': self._failed,
+          'batches': self._batches,
+          'avg_batch_size':
+              float(self._written + self._failed) / self._batches
+              if self._batches else None,
+          'avg_flush_ms':
+              self._flush_seconds * 1000 / self._batches
+              if self._batches else None,
+          'p50_flush_ms':
+              latencies[len(latencies) // 2] * 1000 if latencies else None,
+          'p95_flush_ms':
+              latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] *
+              1000 if latencies else None,
+          'max_flush_ms': latencies[-1] * 1000 if latencies else None,
+      }
@@ -0,0 +1,166 @@
+import numpy
+
+from flightdata import definitions
+from onelog.core import essential
+from onelog.util import geoindex
+
+# Same threshold as analyzer.StopMarker.
+_ALTITUDE_THRESHOLD_FT = 25
+
+
+class FlightTrack(object):
+  """Flight data samples decoded into parallel columns.
+
+  Missing values are NaN. Collect samples by subscribing on_data() to the
+  output of FlightDataCorrector, then call finish() to build the arrays.
+  """
+
+  def __init__(self):
+    self._timestamps = []
+    self._columns = dict((x, []) for x in ('lat', 'lon', 'alt', 'gs'))
+    self.timestamps = None
+    self.lat = None
+    self.lon = None
+    self.alt = None
+    self.gs = None
+
+  def on_data(self, timestamp, datum):
+    self._timestamps.append(timestamp)
+    self._append('lat', datum, definitions.DataType.LATITUDE,
+                 lambda x: x.degree)
+    self._append('lon', datum, definitions.DataType.LONGITUDE,
+                 lambda x: x.degree)
+    self._append('alt', datum, definitions.DataType.ALTITUDE, lambda x: x.ft)
+    self._append('gs', datum, definitions.DataType.GROUND_SPEED,
+                 lambda x: x.knots)
+
+  def _append(self, name, datum, data_type, convert):
+    value = datum.get(data_type)
+    self._columns[name].append(
+        convert(value) if value is not None else float('nan'))
+
+  def finish(self):
+    self.timestamps = self._timestamps
+    for name, values in self._columns.items():
+      setattr(self, name, numpy.array(values, dtype=numpy.float64))
+    self._timestamps = []
+    self._columns = dict((x, []) for x in self._columns)
+    return self
+
+  def __len__(self):
+    return len(self.timestamps or self._timestamps)
+
+
+def _to_unit_vectors(lon, lat):
+  lon = numpy.radians(lon)
+  lat = numpy.radians(lat)
+  return numpy.column_stack((numpy.cos(lat) * numpy.cos(lon),
+                             numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)))
+
+
+def mark_nearby_airports(track, airport_index, max_distance):
+  """Returns the nearest airport of each sample as indices into a list.
+
+  Samples are grouped by grid cell of the index and matched against the
+  airports around that cell in one vectorized step per cell.
+
+  Returns:
+    (airports, indices) where indices holds -1 for samples with no airport
+    within max_distance meters or without a position.
+  """
+  indices = numpy.full(len(track.lat), -1, dtype=numpy.int64)
+  has_position = ~(numpy.isnan(track.lat) | numpy.isnan(track.lon))
+  positions = numpy.nonzero(has_position)[0]
+  airports = []
+  if not len(positions):
+    return (airports, indices)
+
+  lat = track.lat[positions]
+  lon = track.lon[positions]
+  vectors = _to_unit_vectors(lon, lat)
+  cell = airport_index.cell_degrees
+  rows = numpy.floor(lat / cell).astype(numpy.int64)
+  columns = numpy.floor(lon / cell).astype(numpy.int64)
+  max_chord_squared = geoindex.max_chord_squared(max_distance)
+
+  airport_ids = {}
+  order = numpy.lexsort((columns, rows))
+  boundaries = numpy.nonzero(
+      numpy.diff(rows[order]) | numpy.diff(columns[order]))[0] + 1
+  for group in numpy.split(order, boundaries):
+    row = rows[group[0]]
+    column = columns[group[0]]
+    candidates = airport_index.candidates(column * cell, row * cell,
+                                          (column + 1) * cell,
+                                          (row + 1) * cell, max_distance)
+    if not candidates:
+      continue
+
+    candidate_vectors = numpy.array([x[0] for x in candidates])
+    distances = ((vectors[group, numpy.newaxis, :] -
+                  candidate_vectors[numpy.newaxis, :, :])**2).sum(axis=2)
+    nearest = distances.argmin(axis=1)
+    within = distances[numpy.arange(len(group)), nearest] <= max_chord_squared
+    for sample, candidate in zip(group[within], nearest[within]):
+      airport = candidates[candidate][1]
+      airport_id = airport_ids.get(id(airport))
+      if airport_id is None:
+        airport_id = airport_ids[id(airport)] = len(airports)
+        airports.append(airport)
+      indices[positions[sample]] = airport_id
+  return (airports, indices)
+
+
+def mark_stops(track, airports, nearby):
+  """Returns whether each sample is on the ground at its nearby airport."""
+  elevations = numpy.array(
+      [x.elevation for x in airports] + [numpy.nan], dtype=numpy.float64)
+  # Index -1 picks the trailing NaN, which never compares below threshold.
+  agl = track.alt - elevations[nearby]
+  with numpy.errstate(invalid='ignore'):
+    return ((nearby >= 0) & ~numpy.isnan(track.gs) &
+            (agl < _ALTITUDE_THRESHOLD_FT))
+
+
+def detect_route(airports, nearby):
+  """Returns ICAO ids of nearby airports in the order they were passed."""
+  nearby = nearby[nearby >= 0]
+  if not len(nearby):
+    return []
+  icao_ids = numpy.array([x.icao_id for x in airports], dtype=object)[nearby]
+  changes = numpy.concatenate(([True], icao_ids[1:] != icao_ids[:-1]))
+  return list(icao_ids[changes])
+
+
+def count_landings(stopped):
+  """Counts arrivals at an airport after the first time on the ground."""
+  on_ground = numpy.nonzero(stopped)[0]
+  if not len(on_ground):
+    return 0
+  touchdowns = numpy.nonzero(stopped[1:] & ~stopped[:-1])[0] + 1
+  return int((touchdowns > on_ground[0]).sum())
+
+
+def analyze(track, log_entry, airport_index, max_distance):
+  """Adds the fields that the streaming processors of FlightDataAnalyzer
+  derive from flight data to log_entry."""
+  (airports, nearby) = mark_nearby_airports(track, airport_index,
+                                            max_distance)
+  stopped = mark_stops(track, airports, nearby)
+
+  stops = numpy.nonzero(stopped)[0]
+  if len(stops):
+    log_entry.add_field(essential.DepartureAirport,
+                        airports[nearby[stops[0]]].icao_id)
+    log_entry.add_field(essential.ArrivalAirport,
+                        airports[nearby[stops[-1]]].icao_id)
+
+  route = detect_route(airports, nearby)
+  if len(route) > 2:
+    log_entry.add_field(essential.Route, ' '.join(route[1:-1]))
+
+  log_entry.add_field(essential.DayLanding, count_landings(stopped))
+
+  if track.timestamps:
+    log_entry.add_field(essential.TimeOut, track.timestamps[0])
+    log_entry.add_field(essential.TimeIn, track.timestamps[-1])
@@ -1,12 +1,204 @@
+import inspect
+
 from onelog.core import models
+from onelog.core import profiling
+from onelog.core import reference
+
+
+class ComputeEngineException(Exception):
+  pass
+
+
+class ComputeStep(object):
+  """A registered field type together with its declared inputs."""
+
+  def __init__(self, field_type_cls, requires, optional, participant_role):
+    self._field_type_cls = field_type_cls
+    self._requires = requires
+    self._optional = optional
+    self._inputs = frozenset(requires + optional)
+    self._participant_role = participant_role
+
+  @property
+  def field_type_cls(self):
+    return self._field_type_cls
+
+  @property
+  def requires(self):
+    return self._requires
+
+  @property
+  def optional(self):
+    return self._optional
+
+  @property
+  def inputs(self):
+    return self._inputs
+
+  @property
+  def participant_role(self):
+    return self._participant_role
+
+  def to_dict(self):
+    return {
+        'name': self._field_type_cls.__name__,
+        'requires': [x.__name__ for x in self._requires],
+        'optional': [x.__name__ for x in self._optional],
+        'participant_role':
+            self._participant_role.name if self._participant_role else None,
+    }
+
+
+class _ComputePlan(object):
+  """Evaluation order of computable field types.
+
+  Steps are kept topologically sorted by their `require` declarations, so a
+  single pass over the plan visits each field type after all of its inputs.
+  The order is rebuilt on every registration; dependency cycles are rejected
+  before the offending type is registered.
+  """
+
+  def __init__(self):
+    self._steps = {}
+    self._order = []
+
+  def add(self, field_type_cls):
+    if not _overrides_compute(field_type_cls):
+      return
+
+    compute = field_type_cls.compute
+    step = ComputeStep(field_type_cls,
+                       tuple(getattr(compute, 'requires', ())),
+                       tuple(getattr(compute, 'optional', ())),
+                       getattr(compute, 'participant_role', None))
+    steps = dict(self._steps)
+    steps[field_type_cls] = step
+    self._order = _sort_steps(steps)
+    self._steps = steps
+
+  def get(self, field_type_cls):
+    return self._steps.get(field_type_cls)
+
+  @property
+  def steps(self):
+    return list(self._order)
+
+
+def _overrides_compute(field_type_cls):
+  for cls in inspect.getmro(field_type_cls):
+    if 'compute' in cls.__dict__:
+      return cls is not models.LogEntryFieldType
+  return False
+
+
+def _sort_steps(steps):
+  ordered = []
+  visiting = set()
+  visited = set()
+
+  def visit(step, path):
+    cls = step.field_type_cls
+    if cls in visited:
+      return
+    if cls in visiting:
+      cycle = path[path.index(cls):] + [cls]
+      raise ComputeEngineException('Dependency cycle detected: {0}'.format(
+          ' -> '.join(x.__name__ for x in cycle)))
+
+    visiting.add(cls)
+    for dependency in step.requires + step.optional:
+      # Dependencies without a compute step are pure inputs.
+      if dependency in steps:
+        visit(steps[dependency], path + [cls])
+    visiting.remove(cls)
+    visited.add(cls)
+    ordered.append(step)
+
+  for step in sorted(steps.values(), key=lambda x: x.field_type_cls.__name__):
+    visit(step, [])
+  return ordered
+
+
+_plan = _ComputePlan()
+
+# Type id -> reference data kind (see core/reference.py) keyed by its values.
+_reference_fields = {}
+
+# Used by engines created without an explicit profiler.
+_default_profiler = None
 
 
 def register(cls):
+  _plan.add(cls)
   models.LogEntryFieldTypeFactory.register(cls)
   return cls
 
 
-def require(cls_list, participant_role=None):
+def references(kind):
+  """Marks a field type whose values are keys of reference data `kind`.
+
+  Values are split on whitespace, so a route lists several airports.
+  compute_many() prefetches everything marked this way in bulk.
+  """
+
+  def references_decorator(cls):
+    _reference_fields[cls.id()] = kind
+    return cls
+
+  return references_decorator
+
+
+def set_default_profiler(profiler):
+  """Profiles every ComputeEngine created afterwards; None turns it off."""
+  global _default_profiler
+  _default_profiler = profiler
+
+
+def get_plan():
+  """Returns compute steps in evaluation order."""
+  return _plan.steps
+
+
+def get_dependencies(field_type_cls):
+  """Returns field types that `field_type_cls` is computed from."""
+  step = _plan.get(field_type_cls)
+  return list(step.requires + step.optional) if step else []
+
+
+def get_user_changes(original, log_entry):
+  """Returns field types whose values differ between two versions of an entry.
+
+  Fields of `log_entry` whose value differs from `original` were edited or
+  added by the user and are marked user-entered from now on.
+  """
+  before = dict(
+      ((x.type_id, x.airman_id), x.raw_value) for x in original.data_fields)
+  after = dict(
+      ((x.type_id, x.airman_id), x.raw_value) for x in log_entry.data_fields)
+  changed_keys = set(
+      x for x in set(before) | set(after) if before.get(x) != after.get(x))
+
+  for field in log_entry.data_fields:
+    if (field.type_id, field.airman_id) in changed_keys:
+      field.derived = False
+
+  field_types = [
+      models.LogEntryFieldTypeFactory.get(x) for x in set(
+          key[0] for key in changed_keys)
+  ]
+  return [type(x) for x in field_types if x]
+
+
+def require(cls_list, participant_role=None, optional=None):
+  """Declares the inputs of a compute method.
+
+  Args:
+    cls_list: Field types that must all have values; their values are passed
+      to the compute method.
+    participant_role: Only compute for a participant with this role.
+    optional: Field types the compute method reads through the context when
+      present. They are ordered and invalidated like required inputs.
+  """
 
   def require_decorator(func):
 
@@ -23,6 +215,9 @@ def require(cls_list, participant_role=None):
       value = func(self, context, *args)
       return value
 
+    func_wrapper.requires = list(cls_list)
+    func_wrapper.optional = list(optional or [])
+    func_wrapper.participant_role = participant_role
     return func_wrapper
 
   return require_decorator
@@ -30,37 +225,183 @@ def require(cls_list, participant_role=None):
 
 class ComputeEngine(object):
 
-  def __init__(self):
-    self._field_types = models.LogEntryFieldTypeFactory.get_all()
+  def __init__(self, profiler=None):
+    self._steps = [(models.LogEntryFieldTypeFactory.get(
+        x.field_type_cls.id()), x) for x in get_plan()]
+    self._profiler = profiler or _default_profiler
+
+  @property
+  def profiler(self):
+    return self._profiler
+
+  @property
+  def plan(self):
+    return [x[1] for x in self._steps]
 
   def compute(self, log_entry):
-    self._compute_participant(log_entry, None)
-    for participant in log_entry.participants:
-      self._compute_participant(log_entry, participant)
+    self.compute_many([log_entry])
+
+  def compute_many(self, log_entries):
+    """Fills in derived fields that have no value yet."""
+    log_entries = list(log_entries)
+    self._prefetch(log_entries)
+    for log_entry in log_entries:
+      self._compute_participant(log_entry, None, refresh=False)
+      for participant in log_entry.participants:
+        self._compute_participant(log_entry, participant, refresh=False)
+    return log_entries
+
+  def recompute(self, log_entry, field_types=None):
+    return bool(self.recompute_many([log_entry], field_types))
+
+  def recompute_many(self, log_entries, field_types=None):
+    """Brings derived fields up to date after inputs or rules changed.
 
-  def _compute_participant(self, log_entry, participant):
+    Only steps downstream of `field_types` are evaluated, and only derived
+    fields whose value actually changes are touched. User-entered fields are
+    never overwritten. Fields stored before `derived` was recorded count as
+    user-entered until flagged by mark_derived().
+
+    Args:
+      log_entries: Entries to update in place.
+      field_types: Field types whose values or compute rules changed, or None
+        to re-evaluate every step.
+
+    Returns:
+      The entries that changed.
+    """
+    log_entries = list(log_entries)
+    self._prefetch(log_entries)
+    changed_entries = []
+    for log_entry in log_entries:
+      dirty = set(field_types) if field_types is not None else None
+      changed = self._compute_participant(log_entry, None, True, dirty)
+      for participant in log_entry.participants:
+        participant_dirty = set(dirty) if dirty is not None else None
+        changed = self._compute_participant(log_entry, participant, True,
+                                            participant_dirty) or changed
+      if changed:
+        changed_entries.append(log_entry)
+    return changed_entries
+
+  def mark_derived(self, log_entry):
+    """Sets `derived` on fields stored before the flag was recorded.
+
+    Such a field counts as derived if a compute step could have produced it,
+    i.e. its type has a step whose participant role matches and whose
+    required inputs are present. The engine only ever fills in missing
+    fields, so anything else was entered by the user. Only meant for
+    migrating stored entries, see tools/recompute.py --mark-derived.
+
+    Returns:
+      Whether any field was flagged.
+    """
+    steps = dict((x.field_type_cls.id(), x) for _, x in self._steps)
+    participants = dict((x.airman_id, x) for x in log_entry.participants)
+    changed = False
+    for field in log_entry.data_fields or []:
+      if field.derived is not None:
+        continue
+      step = steps.get(field.type_id)
+      field.derived = bool(step) and self._can_compute(
+          step, log_entry, participants.get(field.airman_id),
+          field.airman_id)
+      changed = True
+    return changed
+
+  def _can_compute(self, step, log_entry, participant, airman_id):
+    if step.participant_role and (not participant or
+                                  participant.role != step.participant_role):
+      return False
+    return all(
+        log_entry.get_field(x.id(), airman_id, default_to_shared=True)
+        for x in step.requires)
+
+  def _prefetch(self, log_entries):
+    keys_by_kind = {}
+    for log_entry in log_entries:
+      for field in log_entry.data_fields or []:
+        kind = _reference_fields.get(field.type_id)
+        if kind and field.raw_value:
+          keys_by_kind.setdefault(kind, set()).update(field.raw_value.split())
+
+    if not self._profiler:
+      reference.prefetch(keys_by_kind)
+      return
+    queries = profiling.get_query_count()
+    start = profiling.timer()
+    reference.prefetch(keys_by_kind)
+    self._profiler.record_call('(prefetch)', profiling.timer() - start,
+                               profiling.get_query_count() - queries)
+
+  def _compute_participant(self, log_entry, participant, refresh, dirty=None):
+    """Evaluates the plan for a participant, or for shared fields if None.
+
+    Args:
+      refresh: Whether to re-evaluate steps that already have a derived value.
+      dirty: Field types whose values changed, grown as values change here,
+        or None to evaluate every step.
+
+    Returns:
+      Whether any field was added, updated or removed.
+    """
     context = models.ComputeContext(log_entry, participant)
     airman_id = participant.airman_id if participant else None
+    changed = False
+
+    for field_type, step in self._steps:
+      cls = step.field_type_cls
+      if (dirty is not None and cls not in dirty and
+          dirty.isdisjoint(step.inputs)):
+        continue
+
+      type_id = cls.id()
+      field = log_entry.get_field(type_id, airman_id, default_to_shared=True)
+      if field and (not refresh or not field.derived):
+        continue
+      own_field = field if field and field.airman_id == airman_id else None
+
+      value = self._evaluate(field_type, step, context, log_entry, airman_id)
+      # Save field value only if:
+      #   1) field is shared, or
+      #   2) value is different than value of shared field.
+      if participant and value == log_entry.get_field_value(type_id, None):
+        value = None
 
-    changed = True
-    field_types = [
-        x for x in self._field_types
-        if not log_entry.get_field(
-            type(x).id(), airman_id, default_to_shared=True)
-    ]
-    while changed:
-      changed = False
-      unfilled_field_types = []
-      for field_type in field_types:
-        value = field_type.compute(context)
-        if value is not None:
-          # Save field value only if:
-          #   1) field is shared, or
-          #   2) value is different than value of shared field.
-          if not participant or value != log_entry.get_field_value(
-              type(field_type).id(), None):
-            log_entry.add_field(type(field_type), value, airman_id)
-            changed = True
+      if own_field:
+        if value and field_type.to_string(value) == own_field.raw_value:
+          continue
+        if value:
+          own_field.value = value
         else:
-          unfilled_field_types.append(field_type)
-      field_types = unfilled_field_types
+          log_entry.remove_field(own_field)
+      elif value:
+        log_entry.add_field(cls, value, airman_id, derived=True)
+      else:
+        continue
+
+      changed = True
+      context.invalidate(cls)
+      if dirty is not None:
+        dirty.add(cls)
+    return changed
+
+  def _evaluate(self, field_type, step, context, log_entry, airman_id):
+    participant = context.current_participant
+    if step.participant_role and (not participant or
+                                  participant.role != step.participant_role):
+      return None
+    if not self._can_compute(step, log_entry, participant, airman_id):
+      if self._profiler:
+        self._profiler.record_skip(field_type.name)
+      return None
+
+    if not self._profiler:
+      return field_type.compute(context)
+
+    queries = profiling.get_query_count()
+    start = profiling.timer()
+    value = field_type.compute(context)
+    self._profiler.record_call(field_type.name, profiling.timer() - start,
+                               profiling.get_query_count() - queries)
+    return value
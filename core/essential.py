@@ -3,6 +3,7 @@ import datetime
 from common import unit
 from onelog.core import engine
 from onelog.core import models
+from onelog.core import reference
 from onelog.util import utility
 
 
@@ -15,6 +16,7 @@ class Date(models.BasicLogEntryFieldType):
 
 
 @engine.register
+@engine.references(reference.AIRCRAFT)
 class TailNumber(models.BasicLogEntryFieldType):
 
   def __init__(self):
@@ -43,11 +45,11 @@ class AircraftModel(models.BasicLogEntryFieldType):
 
   @engine.require([TailNumber])
   def compute(self, context, tail_number):
-    aircraft = models.Aircraft.objects(tail_number=tail_number).first()
+    aircraft = reference.get_aircraft(tail_number)
     if not aircraft:
       return
 
-    aircraft_model = aircraft.get_aircraft_model()
+    aircraft_model = reference.get_aircraft_model(aircraft.aircraft_model_code)
     if not aircraft_model:
       return
 
@@ -55,6 +57,7 @@ class AircraftModel(models.BasicLogEntryFieldType):
 
 
 @engine.register
+@engine.references(reference.AIRPORT)
 class DepartureAirport(models.BasicLogEntryFieldType):
 
   def __init__(self):
@@ -65,6 +68,7 @@ class DepartureAirport(models.BasicLogEntryFieldType):
 
 
 @engine.register
+@engine.references(reference.AIRPORT)
 class ArrivalAirport(models.BasicLogEntryFieldType):
 
   def __init__(self):
@@ -75,6 +79,7 @@ class ArrivalAirport(models.BasicLogEntryFieldType):
 
 
 @engine.register
+@engine.references(reference.AIRPORT)
 class Route(models.BasicLogEntryFieldType):
 
   def __init__(self):
@@ -206,11 +211,11 @@ class MultiEngineTime(models.BasicLogEntryFieldType):
 
   @engine.require([TailNumber, TotalTime])
   def compute(self, context, tail_number, total_time):
-    aircraft = models.Aircraft.objects(tail_number=tail_number).first()
+    aircraft = reference.get_aircraft(tail_number)
     if not aircraft:
       return
 
-    aircraft_model = aircraft.get_aircraft_model()
+    aircraft_model = reference.get_aircraft_model(aircraft.aircraft_model_code)
     if not aircraft_model:
       return
     if aircraft_model.number_of_engines <= 1:
@@ -230,11 +235,11 @@ class HighPerformanceTime(models.BasicLogEntryFieldType):
 
   @engine.require([TailNumber, TotalTime])
   def compute(self, context, tail_number, total_time):
-    aircraft = models.Aircraft.objects(tail_number=tail_number).first()
+    aircraft = reference.get_aircraft(tail_number)
     if not aircraft:
       return
 
-    engine_model = aircraft.get_engine_model()
+    engine_model = reference.get_engine_model(aircraft.engine_model_code)
     if not engine_model:
       return
     if engine_model.horsepower <= 200:
@@ -243,6 +248,48 @@ class HighPerformanceTime(models.BasicLogEntryFieldType):
     return total_time
 
 
+def get_airport_geolocation(context, icao_id):
+  """Returns geolocation of an airport, or None if it is unknown."""
+
+  def resolve(context):
+    airport = reference.get_airport(icao_id)
+    try:
+      return airport.geolocation
+    except:
+      return None
+
+  return context.memoize(('airport_geolocation', icao_id), resolve)
+
+
+def get_flight_path(context):
+  """Returns geolocations of the departure airport and every known waypoint.
+
+  Waypoints are the route followed by the arrival airport. Shared by the
+  distance field types; None if the departure airport is unknown.
+  """
+
+  def resolve(context):
+    departure_airport = context.get_field_value(DepartureAirport)
+    arrival_airport = context.get_field_value(ArrivalAirport)
+    route = context.get_field_value(Route)
+
+    start = get_airport_geolocation(context, departure_airport)
+    if start is None:
+      return None
+    path = [start]
+    waypoints = (route.split(' ') if route else []) + [arrival_airport]
+    for waypoint in waypoints:
+      geolocation = get_airport_geolocation(context, waypoint)
+      if geolocation is not None:
+        path.append(geolocation)
+    return path
+
+  return context.memoize(
+      'flight_path',
+      resolve,
+      depends_on=[DepartureAirport, ArrivalAirport, Route])
+
+
 @engine.register
 class TotalDistance(models.BasicLogEntryFieldType):
 
@@ -252,25 +299,15 @@ class TotalDistance(models.BasicLogEntryFieldType):
         display_name='Total Distance',
         data_type=models.LogEntryFieldDataType.FLOAT)
 
-  @engine.require([DepartureAirport, ArrivalAirport])
+  @engine.require([DepartureAirport, ArrivalAirport], optional=[Route])
   def compute(self, context, departure_airport, arrival_airport):
-    route = context.get_field_value(Route)
-
-    prev = None
-    distance = unit.Length()
-    try:
-      prev = models.Airport.objects.get(icao_id=departure_airport)
-    except:
+    path = get_flight_path(context)
+    if not path:
       return None
 
-    waypoints = (route.split(' ') if route else []) + [arrival_airport]
-    for waypoint in waypoints:
-      try:
-        current = models.Airport.objects.get(icao_id=waypoint)
-        distance += current.geolocation - prev.geolocation
-        prev = current
-      except:
-        pass
+    distance = unit.Length()
+    for prev, current in zip(path, path[1:]):
+      distance += current - prev
 
     return distance.nautical_mile
 
@@ -284,26 +321,17 @@ class MaxDistance(models.BasicLogEntryFieldType):
         display_name='Max Distance',
         data_type=models.LogEntryFieldDataType.FLOAT)
 
-  @engine.require([DepartureAirport, ArrivalAirport])
+  @engine.require([DepartureAirport, ArrivalAirport], optional=[Route])
   def compute(self, context, departure_airport, arrival_airport):
-    route = context.get_field_value(Route)
-
-    start = None
-    max_distance = unit.Length()
-    try:
-      start = models.Airport.objects.get(icao_id=departure_airport)
-    except:
+    path = get_flight_path(context)
+    if not path:
       return None
 
-    waypoints = (route.split(' ') if route else []) + [arrival_airport]
-    for waypoint in waypoints:
-      try:
-        current = models.Airport.objects.get(icao_id=waypoint)
-        distance = current.geolocation - start.geolocation
-        if distance.meter > max_distance.meter:
-          max_distance = distance
-      except:
-        pass
+    max_distance = unit.Length()
+    for current in path[1:]:
+      distance = current - path[0]
+      if distance.meter > max_distance.meter:
+        max_distance = distance
 
     return max_distance.nautical_mile
 
@@ -390,22 +418,17 @@ class NightTime(models.BasicLogEntryFieldType):
               time_in):
     time = datetime.timedelta()
 
-    departure_geolocation = None
-    arrival_geolocation = None
-    try:
-      departure_geolocation = models.Airport.objects.get(
-          icao_id=departure_airport).geolocation
-      arrival_geolocation = models.Airport.objects.get(
-          icao_id=arrival_airport).geolocation
-    except:
+    departure_geolocation = get_airport_geolocation(context, departure_airport)
+    arrival_geolocation = get_airport_geolocation(context, arrival_airport)
+    if departure_geolocation is None or arrival_geolocation is None:
       return None
 
     date_out = time_out.date()
     date_in = time_in.date()
     one_day = datetime.timedelta(days=1)
 
-    (dawn, dusk) = utility.get_civil_twilight_time(date_out,
-                                                   departure_geolocation)
+    (dawn, dusk) = utility.get_civil_twilight_time(
+        date_out, departure_geolocation, airport=departure_airport)
     if dawn < dusk:
       if time_out < dawn:
         end_of_day = datetime.combine(date_out + one_day, datetime.time())
@@ -422,7 +445,8 @@ class NightTime(models.BasicLogEntryFieldType):
 
     date = date_out + one_day
     while date <= date_in:
-      (dawn, dusk) = utility.get_civil_twilight_time(date, arrival_geolocation)
+      (dawn, dusk) = utility.get_civil_twilight_time(
+          date, arrival_geolocation, airport=arrival_airport)
       if dawn < dusk:
         time += dawn - datetime.combine(date, datetime.time())
         time += datetime.combine(date + one_day, datetime.time()) - dusk
@@ -430,8 +454,8 @@ class NightTime(models.BasicLogEntryFieldType):
         time += dawn - dusk
       date += one_day
 
-    (dawn, dusk) = utility.get_civil_twilight_time(date_in,
-                                                   arrival_geolocation)
+    (dawn, dusk) = utility.get_civil_twilight_time(
+        date_in, arrival_geolocation, airport=arrival_airport)
     if dawn < dusk:
       if time_in < dawn:
         end_of_day = datetime.combine(date_out + one_day, datetime.time())
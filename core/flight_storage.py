@@ -0,0 +1,214 @@
+import datetime
+import hashlib
+import os
+
+import mongoengine
+from bson import objectid
+
+from onelog.core import models
+
+
+class FlightStorageException(Exception):
+  pass
+
+
+def append_chunk(flight_id, index, data, final):
+  """Stores the next chunk of an upload; see append_chunks()."""
+  append_chunks(flight_id, index, [data], final)
+
+
+def append_chunks(flight_id, index, chunks, final, content_hash=None):
+  """Stores the next chunks of an upload, starting at `index`.
+
+  Chunks are separate documents, so an append writes only the new bytes.
+  The unique (flight_id, index) chunk key and a compare-and-set on
+  FlightData.next_index make concurrent or repeated appends of the same
+  chunks fail instead of corrupting the flight.
+
+  Args:
+    final: Whether the last of `chunks` completes the upload.
+    content_hash: Hash of the whole upload if already known when final;
+      computed from stored chunks otherwise.
+
+  Raises:
+    FlightStorageException: Chunks are out of order or already stored.
+  """
+  if index == 0:
+    if models.FlightData.objects(flight_id=flight_id).count() > 0:
+      raise FlightStorageException('Flight id already exist.')
+  else:
+    flight_data = models.FlightData.objects(flight_id=flight_id).only(
+        'next_index').first()
+    if not flight_data:
+      raise FlightStorageException(
+          'Flight id {0} is not found.'.format(flight_id))
+    if flight_data.next_index != index:
+      raise FlightStorageException(
+          'Expect index {0} but received index {1}.'.format(
+              flight_data.next_index, index))
+
+  upload_id = objectid.ObjectId()
+  now = datetime.datetime.utcnow()
+  documents = [
+      models.FlightDataChunk(
+          flight_id=flight_id,
+          index=index + i,
+          data=data,
+          upload_id=upload_id,
+          created_at=now) for i, data in enumerate(chunks)
+  ]
+  try:
+    models.FlightDataChunk.objects.insert(documents)
+  except mongoengine.NotUniqueError:
+    _delete_chunks(flight_id, upload_id)
+    raise FlightStorageException(
+        'Chunk {0} of flight {1} already exists.'.format(index, flight_id))
+
+  if index == 0:
+    models.FlightData(
+        flight_id=flight_id,
+        next_index=0,
+        size=0,
+        status=models.FlightDataStatus.UPLOADING).save()
+
+  next_index = index + len(chunks)
+  update = {
+      'inc__size': sum(len(x) for x in chunks),
+      'set__last_update': datetime.datetime.utcnow(),
+  }
+  if final:
+    update['set__next_index'] = -1
+    update['set__status'] = models.FlightDataStatus.UPLOADED
+    update['set__content_hash'] = content_hash or get_content_hash(
+        _iter_chunk_documents(flight_id, next_index))
+  else:
+    update['set__next_index'] = next_index
+  updated = models.FlightData.objects(
+      flight_id=flight_id, next_index=index).update_one(**update)
+  if not updated:
+    _delete_chunks(flight_id, upload_id)
+    raise FlightStorageException(
+        'Chunk {0} of flight {1} was appended concurrently.'.format(
+            index, flight_id))
+
+
+def _delete_chunks(flight_id, upload_id):
+  models.FlightDataChunk.objects(
+      flight_id=flight_id, upload_id=upload_id).delete()
+
+
+def get_content_hash(chunks):
+  """Returns SHA-256 of the concatenated chunks."""
+  content_hash = hashlib.sha256()
+  for chunk in chunks:
+    content_hash.update(chunk)
+  return content_hash.hexdigest()
+
+
+def _iter_chunk_documents(flight_id, count=None):
+  query = models.FlightDataChunk.objects(flight_id=flight_id)
+  if count is not None:
+    query = query.filter(index__lt=count)
+  # Chunks are fetched a few at a time to bound memory.
+  for chunk in query.order_by('index').only('data').batch_size(4):
+    yield chunk.data
+
+
+def iter_chunks(flight_data):
+  """Yields the uploaded data of a flight chunk by chunk.
+
+  Flights stored before chunked storage keep their data in FlightData.data.
+  """
+  if flight_data.data:
+    yield flight_data.data
+    return
+  for data in _iter_chunk_documents(flight_data.flight_id):
+    yield data
+
+
+def get_chunk_count(flight_data):
+  """Returns the number of chunks iter_chunks() yields for a flight."""
+  if flight_data.data:
+    return 1
+  return models.FlightDataChunk.objects(
+      flight_id=flight_data.flight_id).count()
+
+
+def open_stream(flight_data):
+  """Returns a read-only file object over the uploaded data of a flight."""
+  if flight_data.data:
+    size = len(flight_data.data)
+  else:
+    size = flight_data.size or 0
+  return FlightDataStream(iter_chunks(flight_data), size)
+
+
+class FlightDataStream(object):
+  """File-like reader over a sequence of chunks.
+
+  Only the current chunk is held in memory. Seeking is lazy: tell() and
+  seek() just move the position, and the next read() skips ahead to it.
+  Seeking back before the current chunk is not supported.
+  """
+
+  def __init__(self, chunks, size):
+    self._chunks = iter(chunks)
+    self._size = size
+    self._chunk = b''
+    # Offset of self._chunk in the stream.
+    self._chunk_start = 0
+    self._offset = 0
+    self._position = 0
+
+  def tell(self):
+    return self._position
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._position
+    elif whence == os.SEEK_END:
+      offset += self._size
+    if offset < 0:
+      raise IOError('Invalid seek position {0}.'.format(offset))
+    self._position = offset
+
+  def read(self, size=-1):
+    self._skip_to_position()
+    parts = []
+    while size is None or size < 0 or size > 0:
+      if self._offset >= len(self._chunk):
+        if not self._next_chunk():
+          break
+      end = (len(self._chunk) if size is None or size < 0 else
+             self._offset + size)
+      part = self._chunk[self._offset:end]
+      self._offset += len(part)
+      if size is not None and size > 0:
+        size -= len(part)
+      parts.append(part)
+    result = b''.join(parts)
+    self._position += len(result)
+    return result
+
+  def _skip_to_position(self):
+    if self._position < self._chunk_start:
+      raise IOError('Cannot seek back to {0} in flight data stream.'.format(
+          self._position))
+    while self._position - self._chunk_start > len(self._chunk):
+      if not self._next_chunk():
+        self._offset = len(self._chunk)
+        return
+    self._offset = self._position - self._chunk_start
+
+  def _next_chunk(self):
+    try:
+      chunk = next(self._chunks)
+    except StopIteration:
+      return False
+    self._chunk_start += len(self._chunk)
+    self._chunk = chunk
+    self._offset = 0
+    return True
+
+  def close(self):
+    self._chunks = iter(())
@@ -0,0 +1,164 @@
+import datetime
+import threading
+
+import mongoengine
+
+from common import pattern
+from onelog.core import models
+from onelog.core import profiling
+
+
+class AnalysisJobQueue(pattern.Logger):
+  """Runs log entry creation jobs stored in Mongo on a pool of threads.
+
+  Jobs are claimed atomically, so several queues could share a collection,
+  but jobs left RUNNING are requeued on start(), which assumes a single
+  server. The number of worker threads bounds how many analyses run at once,
+  independently of the RPC thread pool.
+  """
+
+  # Seconds wait() blocks for a job by default.
+  WAIT_TIMEOUT = 600
+
+  def __init__(self, handler, workers=2, max_attempts=3, retry_delay=30,
+               poll_interval=5, *args, **kwargs):
+    """Creates a stopped queue.
+
+    Args:
+      handler: Called with a flight id; returns the id of the log entry.
+      retry_delay: Seconds before a failed job is retried.
+      poll_interval: Seconds between checks for jobs queued elsewhere.
+    """
+    super(AnalysisJobQueue, self).__init__(*args, **kwargs)
+    self._handler = handler
+    self._workers = workers
+    self._max_attempts = max_attempts
+    self._retry_delay = retry_delay
+    self._poll_interval = poll_interval
+    self._threads = []
+    self._stopped = threading.Event()
+    self._wakeup = threading.Condition()
+    # Job id -> Event set when the job finishes, for callers that wait.
+    self._waiters = {}
+
+  def start(self):
+    models.AnalysisJob.objects(status=models.JobStatus.RUNNING).update(
+        set__status=models.JobStatus.QUEUED)
+    self._stopped.clear()
+    for i in range(self._workers):
+      thread = threading.Thread(
+          target=self._run, name='analysis-worker-{0}'.format(i))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def stop(self, timeout=None):
+    self._stopped.set()
+    with self._wakeup:
+      self._wakeup.notify_all()
+    for thread in self._threads:
+      thread.join(timeout)
+    self._threads = []
+
+  def submit(self, flight_id):
+    """Returns the pending or successful job of a flight, queuing a new one
+    if there is none."""
+    while True:
+      job = models.AnalysisJob.objects(
+          flight_id=flight_id,
+          status__in=[
+              models.JobStatus.QUEUED, models.JobStatus.RUNNING,
+              models.JobStatus.SUCCEEDED
+          ]).order_by('-created_at').first()
+      if job:
+        return job
+
+      now = datetime.datetime.utcnow()
+      job = models.AnalysisJob(
+          flight_id=flight_id,
+          status=models.JobStatus.QUEUED,
+          created_at=now,
+          run_after=now)
+      try:
+        job.save()
+      except mongoengine.NotUniqueError:
+        # Queued concurrently; the unique index allows one pending job per
+        # flight, so look it up again.
+        continue
+      with self._wakeup:
+        self._wakeup.notify()
+      return job
+
+  def get(self, job_id):
+    try:
+      return models.AnalysisJob.objects(id=job_id).first()
+    except mongoengine.ValidationError:
+      # Not a valid job id.
+      return None
+
+  def wait(self, job, timeout=None):
+    """Blocks until a job has finished or `timeout` seconds (WAIT_TIMEOUT if
+    None) have passed; returns its latest state."""
+    if timeout is None:
+      timeout = AnalysisJobQueue.WAIT_TIMEOUT
+    with self._wakeup:
+      event = self._waiters.setdefault(job.id, threading.Event())
+    job = self.get(job.id)
+    if job.status in (models.JobStatus.QUEUED, models.JobStatus.RUNNING):
+      event.wait(timeout)
+      job = self.get(job.id)
+    with self._wakeup:
+      self._waiters.pop(job.id, None)
+    return job
+
+  def _run(self):
+    while not self._stopped.is_set():
+      try:
+        job = self._claim()
+      except Exception:
+        # e.g. Mongo is unreachable; keep the worker alive and retry.
+        self.logger.exception('Failed to claim a job.')
+        job = None
+      if not job:
+        with self._wakeup:
+          self._wakeup.wait(self._poll_interval)
+        continue
+      self._execute(job)
+
+  def _claim(self):
+    return models.AnalysisJob.objects(
+        status=models.JobStatus.QUEUED,
+        run_after__lte=datetime.datetime.utcnow()).order_by(
+            'run_after').modify(
+                new=True,
+                set__status=models.JobStatus.RUNNING,
+                set__started_at=datetime.datetime.utcnow(),
+                inc__attempts=1)
+
+  def _execute(self, job):
+    self.logger.info('Running job {0} for flight {1} (attempt {2})...'.format(
+        job.id, job.flight_id, job.attempts))
+    start = profiling.timer()
+    update = {}
+    try:
+      update['set__log_entry_id'] = self._handler(job.flight_id)
+      update['set__status'] = models.JobStatus.SUCCEEDED
+      update['unset__error'] = True
+    except Exception as e:
+      self.logger.exception('Job {0} failed.'.format(job.id))
+      update['set__error'] = str(e) or type(e).__name__
+      if job.attempts < self._max_attempts:
+        update['set__status'] = models.JobStatus.QUEUED
+        update['set__run_after'] = datetime.datetime.utcnow(
+        ) + datetime.timedelta(seconds=self._retry_delay * job.attempts)
+      else:
+        update['set__status'] = models.JobStatus.FAILED
+    update['set__seconds'] = profiling.timer() - start
+    update['set__finished_at'] = datetime.datetime.utcnow()
+    models.AnalysisJob.objects(id=job.id).update_one(**update)
+
+    if update['set__status'] != models.JobStatus.QUEUED:
+      with self._wakeup:
+        event = self._waiters.get(job.id)
+      if event:
+        event.set()
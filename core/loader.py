@@ -1,27 +1,49 @@
+import csv
 import datetime
 import os
 
 
-class _ColumnHandler(object):
-	def __init__(self, column, field_name, header_names):
-		self._field_name = field_name
-		self._column = column
-		header_name = self._column.header or field_name
-		print('Importing column "{0}"...'.format(header_name))
-		if header_name in header_names:
-			self._index = header_names.index(header_name)
-		else:
-			if self._column.required:
-				raise DataLoaderException('Column "{0}" not found.'.format(header_name), header_names)
-			self._index = None
-
-	def handle(self, loader, values):
-		if self._index is None:
-			setattr(loader, self._field_name, None)
-		else:
-			value = values[self._index]
-			value = self._column.convert(value)
-			setattr(loader, self._field_name, value)
+class _ColumnPlan(object):
+	"""Columns of a loader compiled against a header.
+
+	Each row goes through one loop over (field name, index, converter);
+	index is None for an optional column missing from the file, converter is
+	None when the raw value is kept as is.
+	"""
+	def __init__(self, columns, header_names, verbose=True):
+		self._columns = []
+		self._containers = []
+		for field_name, column in sorted(columns, key=lambda x: x[0]):
+			if isinstance(column, Container):
+				self._containers.append((field_name, column.model_type,
+					_ColumnPlan(column.definitions.items(), header_names, verbose)))
+			else:
+				self._columns.append((field_name, column.get_index(field_name, header_names, verbose),
+					column.get_converter()))
+
+	def convert(self, values, raw_containers=False):
+		"""Returns (field name, value) of every column.
+
+		Containers are model instances, or dicts of their non-empty values if
+		`raw_containers`.
+		"""
+		row = []
+		for field_name, index, converter in self._columns:
+			if index is None:
+				row.append((field_name, None))
+			elif converter is None:
+				row.append((field_name, values[index]))
+			else:
+				row.append((field_name, converter(values[index])))
+		for field_name, model_type, plan in self._containers:
+			if raw_containers:
+				row.append((field_name, dict(x for x in plan.convert(values, True) if x[1] is not None)))
+				continue
+			instance = model_type()
+			for name, value in plan.convert(values):
+				setattr(instance, name, value)
+			row.append((field_name, instance))
+		return row
 
 
 class DataColumn(object):
@@ -38,8 +60,19 @@ class DataColumn(object):
 	def required(self):
 		return self._required
 
-	def get_handler(self, field_name, header_names):
-		return _ColumnHandler(self, field_name, header_names)
+	def get_index(self, field_name, header_names, verbose=True):
+		header_name = self._header or field_name
+		if verbose:
+			print('Importing column "{0}"...'.format(header_name))
+		if header_name in header_names:
+			return header_names.index(header_name)
+		if self._required:
+			raise DataLoaderException('Column "{0}" not found.'.format(header_name), header_names)
+		return None
+
+	def get_converter(self):
+		"""Returns convert, or None if it returns values unchanged."""
+		return self.convert
 
 	def convert(self, value):
 		if self._preprocessor:
@@ -48,7 +81,8 @@ class DataColumn(object):
 
 
 class StringColumn(DataColumn):
-	pass
+	def get_converter(self):
+		return self._preprocessor
 
 
 class BooleanColumn(DataColumn):
@@ -60,6 +94,11 @@ class BooleanColumn(DataColumn):
 
 
 class IntColumn(DataColumn):
+	def get_converter(self):
+		if self._preprocessor:
+			return self.convert
+		return lambda value: int(value) if value else None
+
 	def convert(self, value):
 		value = super(IntColumn, self).convert(value)
 		return int(value) if value else None
@@ -124,19 +163,6 @@ class CustomColumn(DataColumn):
 		return self._loader(value)
 
 
-class _ContainerHandler(object):
-	def __init__(self, container, field_name, header_names):
-		self._container = container
-		self._field_name = field_name
-		self._handlers = [v.get_handler(k, header_names) for k, v in container.definitions.iteritems()]
-
-	def handle(self, loader, values):
-		instance = self._container.model_type()
-		setattr(loader, self._field_name, instance)
-		for handler in self._handlers:
-			handler.handle(instance, values)
-
-
 class Container(DataColumn):
 	def __init__(self, model_type, definitions):
 		super(Container, self).__init__(header=None)
@@ -151,31 +177,61 @@ class Container(DataColumn):
 	def definitions(self):
 		return self._definitions
 
-	def get_handler(self, field_name, header_names):
-		return _ContainerHandler(self, field_name, header_names)
-
 
 class DataLoader(object):
-
-	def __init__(self, filename, delimiter=','):
+	"""Reads rows of a delimited file into the DataColumn attributes of a subclass.
+
+	The default 'csv' parser uses the csv module, which handles quoted
+	delimiters and line breaks; 'split' is the former line splitting parser.
+	Quotes are only special in comma separated files: values of tab separated
+	exports such as LogTen's may contain stray quotes, so there the csv parser
+	splits on the delimiter like 'split' does.
+	"""
+
+	def __init__(self, filename, delimiter=',', parser='csv'):
+		if parser not in ('csv', 'split'):
+			raise DataLoaderException('Unknown parser "{0}".'.format(parser))
 		self._file = None
+		self._reader = None
 		self._filename = filename
 		self._delimiter = delimiter
+		self._parser = parser
 		self._header_names = []
-		self._handlers = []
+		self._plan = None
+		self._row = None
+		# Whether containers are loaded as dicts, for rows written without
+		# their model.
+		self._raw_containers = False
+		self._range = None
 		self._line_number = 0
 		self._total_error = 0
 		self._total_size = os.path.getsize(self._filename)
 		self._read_size = 0
 
 	def __enter__(self):
-		self._file = open(self._filename, 'r')
+		self._file = open(self._filename, 'rb' if self._parser == 'csv' else 'r')
 		self._load_header()
+		if self._range:
+			self._file.seek(self._range[0])
+			self._read_size = 0
+		if self._parser == 'csv':
+			self._reader = self._csv_reader(self._iter_lines())
 		return self
 
 	def __exit__(self, exc_type, exc_value, exc_tb):
 		self._file.close()
-		print('Total error: {0}'.format(self._total_error))
+		if not self._range:
+			print('Total error: {0}'.format(self._total_error))
+
+	def select_range(self, start, end):
+		"""Limits loading to the rows in [start, end) of the file.
+
+		Must be called before entering the loader. `start` must be the start of
+		a record, see split_byte_ranges(). Progress and line numbers are relative
+		to the range, and column and error messages are not printed.
+		"""
+		self._range = (start, end)
+		self._total_size = end - start
 
 	@property
 	def line_number(self):
@@ -185,6 +241,11 @@ class DataLoader(object):
 	def total_error(self):
 		return self._total_error
 
+	@property
+	def row(self):
+		"""(field name, value) of every column of the current row."""
+		return self._row
+
 	@property
 	def progress(self):
 		return float(self._read_size) / self._total_size if self._total_size > 0 else None
@@ -200,12 +261,13 @@ class DataLoader(object):
 				return False
 
 			try:
-				for handler in self._handlers:
-					handler.handle(self, self._values)
+				row = self._plan.convert(self._values, self._raw_containers)
 			except Exception as e:
 				self._total_error += 1
 				continue
 
+			self._row = row
+			self.__dict__.update(row)
 			return True
 
 	def has_data(self):
@@ -221,15 +283,66 @@ class DataLoader(object):
 		self._line_number += 1
 		line = self._file.readline()
 		self._read_size += len(line)
-
-		line = line.lstrip('\xef\xbb\xbf').rstrip('\n')
-		self._header_names = [x.strip('" ') for x in line.split(self._delimiter)]
+		line = line.lstrip('\xef\xbb\xbf')
+		if self._parser == 'csv':
+			names = next(self._csv_reader([line]), [])
+		else:
+			names = line.rstrip('\n').split(self._delimiter)
+		self._header_names = [x.strip('" ') for x in names]
 
 		cls = type(self)
-		field_names = [x for x in dir(cls) if isinstance(getattr(cls, x), DataColumn)]
-		self._handlers = [getattr(cls, x).get_handler(x, self._header_names) for x in field_names]
+		columns = [(x, getattr(cls, x)) for x in dir(cls) if isinstance(getattr(cls, x), DataColumn)]
+		self._plan = _ColumnPlan(columns, self._header_names, verbose=not self._range)
+
+	def _csv_reader(self, lines):
+		if _is_quoted(self._delimiter):
+			return csv.reader(lines, delimiter=self._delimiter)
+		return csv.reader(lines, delimiter=self._delimiter, quoting=csv.QUOTE_NONE)
 
 	def _load_values(self):
+		if self._parser == 'csv':
+			return self._read_values()
+		return self._split_values()
+
+	def _read_values(self):
+		total_columns = len(self._header_names)
+		values = self._read_record()
+		while values is not None:
+			if len(values) == total_columns:
+				return [x.strip('" ') for x in values]
+			elif len(values) < total_columns:
+				# A line break in an unquoted value; the record goes on in the next line.
+				next_values = self._read_record()
+				if next_values is None:
+					self._total_error += 1
+					return None
+				if values and next_values:
+					values[-1] += '\n' + next_values[0]
+					next_values = next_values[1:]
+				values += next_values
+			else:
+				self._total_error += 1
+				values = self._read_record()
+		return None
+
+	def _read_record(self):
+		while True:
+			try:
+				return next(self._reader)
+			except StopIteration:
+				return None
+			except csv.Error:
+				self._total_error += 1
+
+	def _iter_lines(self):
+		for line in self._file:
+			if self._range and self._read_size >= self._total_size:
+				return
+			self._line_number += 1
+			self._read_size += len(line)
+			yield line
+
+	def _split_values(self):
 		total_columns = len(self._header_names)
 		row = self._load_row()
 		while row:
@@ -248,6 +361,8 @@ class DataLoader(object):
 		return None
 
 	def _load_row(self):
+		if self._range and self._read_size >= self._total_size:
+			return None
 		self._line_number += 1
 		line = self._file.readline()
 		if not line:
@@ -261,4 +376,33 @@ class DataLoaderException(Exception):
 	pass
 
 
+def _is_quoted(delimiter):
+	# Whether quotes are special to the csv parser, see DataLoader.
+	return delimiter == ','
+
+
+def split_byte_ranges(filename, range_size, delimiter=','):
+	"""Splits the rows of a file after its header into [start, end) byte ranges.
+
+	Ranges are about `range_size` bytes and start at the beginning of a line.
+	Where quotes are special (see DataLoader), a line break counts only if an
+	even number of quotes precedes it, so a quoted value with a line break
+	never crosses ranges.
+	"""
+	total_size = os.path.getsize(filename)
+	quoted = _is_quoted(delimiter)
+	with open(filename, 'rb') as f:
+		f.readline()
+		starts = [f.tell()]
+		position = starts[0]
+		in_quotes = False
+		for line in f:
+			position += len(line)
+			if quoted and line.count('"') % 2:
+				in_quotes = not in_quotes
+			if not in_quotes and position - starts[-1] >= range_size and position < total_size:
+				starts.append(position)
+	return zip(starts, starts[1:] + [total_size])
+
+
 
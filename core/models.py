@@ -292,6 +292,9 @@ class ComputeContext(object):
   def __init__(self, log_entry, current_participant):
     self._log_entry = log_entry
     self._current_participant = current_participant
+    # Field type -> value, and key -> (value, field types it depends on).
+    self._values = {}
+    self._shared = {}
 
   @property
   def log_entry(self):
@@ -306,11 +309,42 @@ class ComputeContext(object):
     return self._current_participant
 
   def get_field_value(self, field_type_cls):
-    return self._log_entry.get_field_value(
+    if field_type_cls in self._values:
+      return self._values[field_type_cls]
+
+    value = self._log_entry.get_field_value(
         field_type_cls.id(),
         self._current_participant.airman_id
         if self._current_participant else None,
         default_to_shared=True)
+    self._values[field_type_cls] = value
+    return value
+
+  def publish(self, key, value, depends_on=()):
+    """Shares an intermediate result with other field types.
+
+    The value is dropped once any field type in `depends_on` changes.
+    """
+    self._shared[key] = (value, frozenset(depends_on))
+
+  def get_shared(self, key, default=None):
+    entry = self._shared.get(key)
+    return entry[0] if entry else default
+
+  def memoize(self, key, func, depends_on=()):
+    """Returns the shared value of `key`, publishing func(context) if unset."""
+    entry = self._shared.get(key)
+    if entry:
+      return entry[0]
+    value = func(self)
+    self.publish(key, value, depends_on)
+    return value
+
+  def invalidate(self, field_type_cls):
+    """Forgets memoized values that depend on a field type that changed."""
+    self._values.pop(field_type_cls, None)
+    for key in [k for k, v in self._shared.items() if field_type_cls in v[1]]:
+      del self._shared[key]
 
 
 class LogEntryFieldDataType(enum.Enum):
@@ -476,17 +510,81 @@ class LogEntryField(mongoengine.EmbeddedDocument):
   type_id = fields.IntField()
   raw_value = fields.StringField()
   airman_id = fields.IntField()
+  # Whether ComputeEngine filled in the value. Unset on fields stored before
+  # the flag existed; see ComputeEngine.mark_derived().
+  derived = fields.BooleanField()
+
+  # Shared by all fields; see get_value_cache_stats().
+  _value_cache_hits = 0
+  _value_cache_misses = 0
 
   @property
   def value(self):
+    # Decoded value is cached with the (type_id, raw_value) it came from, so
+    # any change to either one invalidates it.
+    cache = getattr(self, '_value_cache', None)
+    if (cache is not None and cache[0] == self.type_id and
+        cache[1] == self.raw_value):
+      LogEntryField._value_cache_hits += 1
+      return cache[2]
+
+    LogEntryField._value_cache_misses += 1
     field_type = LogEntryFieldTypeFactory.get(self.type_id)
-    return field_type.from_string(self.raw_value)
+    value = field_type.from_string(self.raw_value)
+    self._value_cache = (self.type_id, self.raw_value, value)
+    return value
 
   @value.setter
   def value(self, value):
     field_type = LogEntryFieldTypeFactory.get(self.type_id)
     self.raw_value = field_type.to_string(value)
 
+  @staticmethod
+  def get_value_cache_stats():
+    hits = LogEntryField._value_cache_hits
+    misses = LogEntryField._value_cache_misses
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / total if total else None,
+    }
+
+  @staticmethod
+  def reset_value_cache_stats():
+    LogEntryField._value_cache_hits = 0
+    LogEntryField._value_cache_misses = 0
+
+
+class _LogEntryFieldIndex(object):
+  """Lookup of LogEntry.data_fields by (type_id, airman_id)."""
+
+  def __init__(self, data_fields):
+    self._data_fields = data_fields
+    self._size = 0
+    self._fields = {}
+    self._shared_fields = {}
+    for field in data_fields or []:
+      self.add(field)
+
+  def is_valid_for(self, data_fields):
+    return (self._data_fields is data_fields and
+            self._size == len(data_fields or []))
+
+  def add(self, field):
+    # First field wins for an exact match, last shared field wins as the
+    # fallback, same as a linear scan over data_fields.
+    self._size += 1
+    self._fields.setdefault((field.type_id, field.airman_id), field)
+    if not field.airman_id:
+      self._shared_fields[field.type_id] = field
+
+  def get(self, type_id, airman_id=None, default_to_shared=True):
+    field = self._fields.get((type_id, airman_id))
+    if field is not None:
+      return field
+    return self._shared_fields.get(type_id) if default_to_shared else None
+
 
 class LogEntryType(enum.Enum):
   FLIGHT = 1
@@ -530,7 +628,13 @@ class LogEntry(mongoengine.Document):
 
   status = extra_fields.IntEnumField(LogEntryStatus)
 
-  def add_field(self, field_type_cls, value, airman_id=None):
+  meta = {
+      'indexes': [
+          'flight_id',
+      ]
+  }
+
+  def add_field(self, field_type_cls, value, airman_id=None, derived=False):
     if not value:
       return
 
@@ -538,20 +642,29 @@ class LogEntry(mongoengine.Document):
     field.type_id = field_type_cls.id()
     field.airman_id = airman_id
     field.value = value
+    field.derived = bool(derived)
 
     if self.data_fields is None:
       self.data_fields = []
+    index = self._get_field_index()
     self.data_fields.append(field)
+    index.add(field)
+
+  def remove_field(self, field):
+    self.data_fields.remove(field)
+    self._field_index = None
 
   def get_field(self, type_id, airman_id=None, default_to_shared=True):
-    default = None
-    for field in self.data_fields:
-      if field.type_id == type_id:
-        if field.airman_id == airman_id:
-          return field
-        elif default_to_shared and not field.airman_id:
-          default = field
-    return default
+    return self._get_field_index().get(type_id, airman_id, default_to_shared)
+
+  def _get_field_index(self):
+    # Rebuilt whenever data_fields is replaced (e.g. on document load) or
+    # resized outside of add_field().
+    index = getattr(self, '_field_index', None)
+    if index is None or not index.is_valid_for(self.data_fields):
+      index = _LogEntryFieldIndex(self.data_fields)
+      self._field_index = index
+    return index
 
   def get_field_value(self,
                       type_id,
@@ -606,10 +719,107 @@ class FlightDataStatus(enum.Enum):
 
 class FlightData(mongoengine.Document):
   flight_id = fields.StringField()
+  # Only set on flights uploaded before FlightDataChunk existed.
   data = fields.BinaryField()
   next_index = fields.IntField()
+  # Total bytes of all chunks.
+  size = fields.IntField()
   status = extra_fields.IntEnumField(FlightDataStatus)
   last_update = fields.DateTimeField()
+  # SHA-256 of data, set once the upload is complete.
+  content_hash = fields.StringField()
+
+  meta = {
+      'indexes': [
+          'flight_id',
+      ]
+  }
+
+
+class FlightDataChunk(mongoengine.Document):
+  """One uploaded chunk of flight data; see core/flight_storage.py."""
+  flight_id = fields.StringField(required=True)
+  index = fields.IntField(required=True)
+  data = fields.BinaryField()
+  # Chunks appended together share an id, so a failed append can be undone.
+  upload_id = fields.ObjectIdField()
+  created_at = fields.DateTimeField()
+
+  meta = {
+      'indexes': [
+          {
+              'fields': ['flight_id', 'index'],
+              'unique': True
+          },
+      ]
+  }
+
+
+class FlightAnalysis(mongoengine.Document):
+  """Cached results of analyzing flight data with the given content hash.
+
+  Results are filled in on first use; see core/analysis_cache.py.
+  """
+  content_hash = fields.StringField(required=True)
+  analyzer_version = fields.IntField(required=True)
+  # Recorded fields only; derived fields are computed on use.
+  data_fields = fields.EmbeddedDocumentListField(LogEntryField)
+  # [seconds since epoch, latitude, longitude, altitude in feet]
+  track = fields.ListField(fields.ListField(fields.FloatField()))
+  # zlib-compressed KML.
+  kml = fields.BinaryField()
+  created_at = fields.DateTimeField()
+
+  meta = {
+      'indexes': [
+          {
+              'fields': ['content_hash', 'analyzer_version'],
+              'unique': True
+          },
+      ]
+  }
+
+
+class JobStatus(enum.Enum):
+  QUEUED = 1
+  RUNNING = 2
+  SUCCEEDED = 3
+  FAILED = 4
+
+
+class AnalysisJob(mongoengine.Document):
+  """A queued request to create the log entry of a flight; see core/jobs.py."""
+  flight_id = fields.StringField(required=True)
+  status = extra_fields.IntEnumField(JobStatus)
+  attempts = fields.IntField(default=0)
+  error = fields.StringField()
+  log_entry_id = fields.ObjectIdField()
+
+  created_at = fields.DateTimeField()
+  # Not picked up before this time; pushed back on retry.
+  run_after = fields.DateTimeField()
+  started_at = fields.DateTimeField()
+  finished_at = fields.DateTimeField()
+  # Wall time of the last attempt.
+  seconds = fields.FloatField()
+
+  meta = {
+      'indexes': [
+          ('status', 'run_after'),
+          'flight_id',
+          # At most one QUEUED or RUNNING job per flight.
+          {
+              'name': 'flight_id_pending',
+              'fields': ['flight_id'],
+              'unique': True,
+              'partialFilterExpression': {
+                  'status': {
+                      '$lte': JobStatus.RUNNING.value
+                  }
+              },
+          },
+      ]
+  }
 
 
 # Keep in sync with FlightEvent in flight.proto
@@ -625,3 +835,10 @@ class FlightEvent(mongoengine.Document):
   flight_id = fields.StringField()
   timestamp = fields.DateTimeField()
   event_type = extra_fields.IntEnumField(FlightEventType)
+
+  meta = {
+      'indexes': [
+          ('flight_id', 'timestamp'),
+          'timestamp',
+      ]
+  }
@@ -0,0 +1,198 @@
+import collections
+import threading
+import timeit
+
+import mongoengine
+from pymongo import monitoring
+
+timer = timeit.default_timer
+
+_local = threading.local()
+
+
+class _QueryCounter(monitoring.CommandListener):
+  """Counts MongoDB commands issued by the current thread."""
+
+  def started(self, event):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+  def succeeded(self, event):
+    pass
+
+  def failed(self, event):
+    pass
+
+
+_query_counter = None
+
+
+def install():
+  """Starts counting MongoDB commands for get_query_count().
+
+  Off by default, as the listener runs on every command. pymongo only
+  notifies clients created after a listener is registered, so the default
+  connection is reopened.
+  """
+  global _query_counter
+  if _query_counter:
+    return
+  _query_counter = _QueryCounter()
+  monitoring.register(_query_counter)
+  mongoengine.connection.disconnect()
+  mongoengine.connect('onelog')
+
+
+def get_query_count():
+  """Returns the number of MongoDB commands issued so far by this thread,
+  always 0 unless install() was called."""
+  return getattr(_local, 'queries', 0)
+
+
+class StageStats(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.calls = 0
+    self.skips = 0
+    self.seconds = 0.0
+    self.queries = 0
+
+  def to_dict(self):
+    return {
+        'name': self.name,
+        'calls': self.calls,
+        'skips': self.skips,
+        'seconds': self.seconds,
+        'queries': self.queries,
+    }
+
+
+class Profiler(object):
+  """Accumulates call counts, skips, wall time and DB queries per name."""
+
+  def __init__(self):
+    self._stats = {}
+    self._lock = threading.Lock()
+
+  def _get(self, name):
+    stats = self._stats.get(name)
+    if stats is None:
+      stats = self._stats.setdefault(name, StageStats(name))
+    return stats
+
+  def record_call(self, name, seconds, queries):
+    with self._lock:
+      stats = self._get(name)
+      stats.calls += 1
+      stats.seconds += seconds
+      stats.queries += queries
+
+  def record_skip(self, name):
+    with self._lock:
+      self._get(name).skips += 1
+
+  def reset(self):
+    with self._lock:
+      self._stats = {}
+
+  def report(self):
+    """Returns stats of every name, most expensive first."""
+    with self._lock:
+      stats = [x.to_dict() for x in self._stats.values()]
+    return sorted(stats, key=lambda x: x['seconds'], reverse=True)
+
+  def format_report(self):
+    lines = ['{0:<35} | {1:>8} | {2:>8} | {3:>10} | {4:>10} | {5:>8}'.format(
+        'NAME', 'CALLS', 'SKIPS', 'TOTAL (s)', 'AVG (ms)', 'QUERIES')]
+    for stats in self.report():
+      lines.append(
+          '{0:<35} | {1:>8} | {2:>8} | {3:>10.3f} | {4:>10.3f} | {5:>8}'.format(
+              stats['name'], stats['calls'], stats['skips'], stats['seconds'],
+              stats['seconds'] * 1000 / stats['calls'] if stats['calls'] else 0,
+              stats['queries']))
+    return '\n'.join(lines)
+
+
+class PipelineStageStats(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.samples_in = 0
+    self.samples_out = 0
+    self.seconds = 0.0
+    self.queries = 0
+
+  def to_dict(self):
+    return {
+        'name': self.name,
+        'samples_in': self.samples_in,
+        'samples_out': self.samples_out,
+        'seconds': self.seconds,
+        'queries': self.queries,
+        'samples_per_second':
+            self.samples_in / self.seconds if self.seconds else None,
+    }
+
+
+class PipelineProfiler(object):
+  """Accumulates samples in/out, wall time and DB queries per pipeline stage.
+
+  Stages of an event pipeline call each other synchronously, so the time and
+  queries of a call are charged to its stage minus those of the downstream
+  stages it emitted to. Not thread-safe; use one profiler per pipeline.
+  """
+
+  def __init__(self):
+    self._stages = collections.OrderedDict()
+    # [seconds, queries] spent in nested stages, one per active call.
+    self._stack = []
+
+  def _get(self, name):
+    stats = self._stages.get(name)
+    if stats is None:
+      stats = self._stages[name] = PipelineStageStats(name)
+    return stats
+
+  def wrap(self, name, func):
+    """Returns func instrumented as stage `name`; each call is a sample in."""
+    stats = self._get(name)
+
+    def wrapper(*args, **kwargs):
+      stats.samples_in += 1
+      queries = get_query_count()
+      start = timer()
+      self._stack.append([0.0, 0])
+      try:
+        return func(*args, **kwargs)
+      finally:
+        (nested_seconds, nested_queries) = self._stack.pop()
+        seconds = timer() - start
+        queries = get_query_count() - queries
+        stats.seconds += seconds - nested_seconds
+        stats.queries += queries - nested_queries
+        if self._stack:
+          self._stack[-1][0] += seconds
+          self._stack[-1][1] += queries
+
+    return wrapper
+
+  def count_output(self, name):
+    self._get(name).samples_out += 1
+
+  def reset(self):
+    self._stages = collections.OrderedDict()
+
+  def report(self):
+    """Returns stats of every stage in pipeline order."""
+    return [x.to_dict() for x in self._stages.values()]
+
+  def format_report(self):
+    lines = ['{0:<35} | {1:>10} | {2:>10} | {3:>10} | {4:>12} | {5:>8}'.format(
+        'STAGE', 'IN', 'OUT', 'TOTAL (s)', 'SAMPLES/s', 'QUERIES')]
+    for stats in self.report():
+      lines.append(
+          '{0:<35} | {1:>10} | {2:>10} | {3:>10.3f} | {4:>12.0f} | {5:>8}'.format(
+              stats['name'], stats['samples_in'], stats['samples_out'],
+              stats['seconds'], stats['samples_per_second'] or 0,
+              stats['queries']))
+    return '\n'.join(lines)
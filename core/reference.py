@@ -0,0 +1,178 @@
+"""Process-wide cache of FAA reference data.
+
+Aircraft, aircraft models, engine models and airports are looked up over and
+over while computing log entries but change at most daily, so lookups go
+through read-through LRU caches instead of querying MongoDB every time.
+"""
+
+import threading
+import time
+
+from onelog.core import models
+from onelog.util import cache
+from onelog.util import geoindex
+
+AIRCRAFT = 'aircraft'
+AIRPORT = 'airport'
+
+_TTL_SECONDS = 24 * 3600
+# How often to check whether the airport collection changed.
+_AIRPORT_INDEX_CHECK_SECONDS = 300
+
+_aircraft = cache.LruCache('aircraft', max_size=4096, ttl=_TTL_SECONDS)
+_aircraft_models = cache.LruCache(
+    'aircraft_model', max_size=4096, ttl=_TTL_SECONDS)
+_engine_models = cache.LruCache(
+    'engine_model', max_size=4096, ttl=_TTL_SECONDS)
+_airports = cache.LruCache('airport', max_size=16384, ttl=_TTL_SECONDS)
+
+_CACHES = {
+    models.Aircraft: _aircraft,
+    models.AircraftModel: _aircraft_models,
+    models.EngineModel: _engine_models,
+    models.Airport: _airports,
+}
+
+
+def get_aircraft(tail_number):
+  if not tail_number:
+    return None
+  return _aircraft.get(
+      tail_number,
+      lambda x: models.Aircraft.objects(tail_number=x).first())
+
+
+def get_aircraft_model(code):
+  if code is None:
+    return None
+  return _aircraft_models.get(
+      code,
+      lambda x: models.AircraftModel.objects(code=x).first())
+
+
+def get_engine_model(code):
+  if code is None:
+    return None
+  return _engine_models.get(
+      code,
+      lambda x: models.EngineModel.objects(code=x).first())
+
+
+def get_airport(icao_id):
+  if not icao_id:
+    return None
+  return _airports.get(
+      icao_id,
+      lambda x: models.Airport.objects(icao_id=x).first())
+
+
+class _AirportIndex(object):
+  """Spatial index of all airports, rebuilt when the collection changes."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._index = None
+    self._signature = None
+    self._checked_at = 0
+
+  def get(self):
+    now = time.time()
+    if self._is_fresh(now):
+      return self._index
+
+    with self._lock:
+      if self._is_fresh(now):
+        return self._index
+      signature = self._get_signature()
+      if self._index is None or signature != self._signature:
+        airports = models.Airport.objects(location__exists=True)
+        self._index = geoindex.GeoGridIndex(
+            (x.location['coordinates'][0], x.location['coordinates'][1], x)
+            for x in airports)
+        self._signature = signature
+      self._checked_at = now
+      return self._index
+
+  def invalidate(self):
+    with self._lock:
+      self._index = None
+
+  def _is_fresh(self, now):
+    return (self._index is not None and
+            now - self._checked_at < _AIRPORT_INDEX_CHECK_SECONDS)
+
+  @staticmethod
+  def _get_signature():
+    last_id = models.Airport.objects.order_by('-id').scalar('id').first()
+    return (models.Airport.objects.count(), last_id)
+
+
+_airport_index = _AirportIndex()
+
+
+def get_airport_index():
+  """Returns a GeoGridIndex of every airport, keyed by its location."""
+  return _airport_index.get()
+
+
+def prefetch(keys_by_kind):
+  """Loads reference data for many keys with one `$in` query per collection.
+
+  Args:
+    keys_by_kind: Dict from AIRCRAFT or AIRPORT to the keys to load.
+  """
+  prefetch_aircraft(keys_by_kind.get(AIRCRAFT, []))
+  prefetch_airports(keys_by_kind.get(AIRPORT, []))
+
+
+def prefetch_aircraft(tail_numbers):
+  aircraft = _bulk_load(_aircraft, models.Aircraft, 'tail_number',
+                        tail_numbers)
+  _bulk_load(_aircraft_models, models.AircraftModel, 'code',
+             [x.aircraft_model_code for x in aircraft])
+  _bulk_load(_engine_models, models.EngineModel, 'code',
+             [x.engine_model_code for x in aircraft])
+
+
+def prefetch_airports(icao_ids):
+  _bulk_load(_airports, models.Airport, 'icao_id', icao_ids)
+
+
+def _bulk_load(c, model, key_name, keys):
+  keys = c.missing(set(x for x in keys if x is not None))
+  if not keys:
+    return []
+
+  documents = {}
+  for document in model.objects(**{key_name + '__in': keys}):
+    documents.setdefault(getattr(document, key_name), document)
+  for key in keys:
+    # Unknown keys are cached as None, same as a single lookup.
+    c.put(key, documents.get(key))
+  return documents.values()
+
+
+def invalidate(model=None, key=None):
+  """Drops cached entries.
+
+  Args:
+    model: Document class whose cache to clear, or None for all caches.
+    key: Single key to drop from that cache, or None for the whole cache.
+  """
+  if model:
+    caches = [_CACHES[model]] if model in _CACHES else []
+  else:
+    caches = _CACHES.values()
+  for c in caches:
+    c.invalidate(key)
+  if model in (None, models.Airport):
+    _airport_index.invalidate()
+
+
+def get_stats():
+  return [x.get_stats() for x in _CACHES.values()]
+
+
+def reset_stats():
+  for c in _CACHES.values():
+    c.reset_stats()
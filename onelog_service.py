@@ -1,5 +1,7 @@
+import gflags
 import grpc
-import time
+import signal
+import threading
 
 from concurrent import futures
 from google.apputils import app as gapp
@@ -8,21 +10,92 @@ from common import app
 from flightdata import flight_pb2_grpc
 from onelog.services import flight_service
 
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_integer('port', 50051, 'Port to serve on.')
+gflags.DEFINE_integer(
+    'max_workers', 50,
+    'Threads serving RPCs. Handlers mostly wait on the network; Mongo writes '
+    'and analysis are bounded by --storage_workers and --analysis_workers.')
+gflags.DEFINE_integer(
+    'max_concurrent_rpcs', None,
+    'RPCs beyond this many in flight are rejected with RESOURCE_EXHAUSTED '
+    'instead of queuing. Unlimited if not set.')
+gflags.DEFINE_integer('storage_workers', 8,
+                      'Threads writing streamed uploads to Mongo.')
+gflags.DEFINE_integer('analysis_workers', 2,
+                      'Log entries analyzed concurrently.')
+gflags.DEFINE_integer('event_batch_size', 500,
+                      'Flight events inserted together.')
+gflags.DEFINE_integer('event_flush_ms', 200,
+                      'Max time a flight event waits for its batch.')
+gflags.DEFINE_boolean(
+    'durable_events', True,
+    'Acknowledge flight events only after they are written, instead of as '
+    'soon as they are queued.')
+gflags.DEFINE_integer('max_message_mb', 16,
+                      'Max size of a request or response message.')
+gflags.DEFINE_integer('keepalive_time_ms', 60000,
+                      'Interval of keepalive pings on idle connections.')
+gflags.DEFINE_integer('keepalive_timeout_ms', 20000,
+                      'Time to wait for a keepalive ping to be acknowledged.')
+gflags.DEFINE_integer(
+    'min_ping_interval_ms', 10000,
+    'Minimum interval between client pings before the client is dropped.')
+gflags.DEFINE_integer(
+    'shutdown_grace_seconds', 30,
+    'On SIGTERM or SIGINT, time given to in-flight RPCs to finish.')
+
 
 class ServiceApp(app.App):
   def run(self):
     self.init_logging('../logs/onelog_service')
 
     self.logger.info('Starting GRPC server...')
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    flight_pb2_grpc.add_FlightServiceServicer_to_server(
-      flight_service.FlightService(), server)
-    server.add_insecure_port('[::]:50051')
+    max_message_bytes = FLAGS.max_message_mb * 1024 * 1024
+    server = grpc.server(
+      futures.ThreadPoolExecutor(max_workers=FLAGS.max_workers),
+      options=[
+        ('grpc.max_receive_message_length', max_message_bytes),
+        ('grpc.max_send_message_length', max_message_bytes),
+        ('grpc.keepalive_time_ms', FLAGS.keepalive_time_ms),
+        ('grpc.keepalive_timeout_ms', FLAGS.keepalive_timeout_ms),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.min_ping_interval_without_data_ms',
+         FLAGS.min_ping_interval_ms),
+        ('grpc.http2.max_pings_without_data', 0),
+      ],
+      maximum_concurrent_rpcs=FLAGS.max_concurrent_rpcs)
+    servicer = flight_service.FlightService(
+      analysis_workers=FLAGS.analysis_workers,
+      storage_workers=FLAGS.storage_workers,
+      event_batch_size=FLAGS.event_batch_size,
+      event_flush_interval=FLAGS.event_flush_ms / 1000.0,
+      durable_events=FLAGS.durable_events)
+    flight_pb2_grpc.add_FlightServiceServicer_to_server(servicer, server)
+    flight_service.add_streaming_handlers(servicer, server)
+    server.add_insecure_port('[::]:{0}'.format(FLAGS.port))
+    servicer.start()
     server.start()
-    self.logger.info('GRPC server started.')
+    self.logger.info('GRPC server started on port {0}.'.format(FLAGS.port))
+
+    stopping = threading.Event()
+
+    def on_signal(signum, frame):
+      self.logger.info('Received signal {0}, shutting down...'.format(signum))
+      stopping.set()
 
-    while True:
-      time.sleep(1)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # Event.wait() without a timeout cannot be interrupted by signals.
+    while not stopping.wait(1):
+      pass
+
+    # New RPCs are rejected right away; in-flight ones get the grace period.
+    server.stop(FLAGS.shutdown_grace_seconds).wait()
+    servicer.stop()
+    self.logger.info('GRPC server stopped.')
 
 
 def main(unused_argv):
@@ -31,4 +104,3 @@ def main(unused_argv):
 
 if __name__ == "__main__":
   gapp.run()
-
@@ -1,15 +1,77 @@
-import datetime
+import hashlib
+import threading
+import time
+
+import grpc
+from concurrent import futures
 
 from flightdata import flight_pb2
 from flightdata import flight_pb2_grpc
+from onelog.core import analysis_cache
 from onelog.core import analyzer
+from onelog.core import bulk_writer
 from onelog.core import essential
+from onelog.core import flight_storage
+from onelog.core import jobs
 from onelog.core import models
 from common import pattern
 
 
 class FlightService(flight_pb2_grpc.FlightServiceServicer, pattern.Logger):
 
+  # Sessions of flights that stop uploading are dropped after this long.
+  _SESSION_TIMEOUT_SECONDS = 6 * 3600
+  # A streamed upload is written whenever either limit is reached.
+  _STREAM_BATCH_CHUNKS = 16
+  _STREAM_BATCH_BYTES = 4 * 1024 * 1024
+
+  def __init__(self,
+               analysis_workers=2,
+               storage_workers=8,
+               event_batch_size=500,
+               event_flush_interval=0.2,
+               durable_events=True,
+               *args,
+               **kwargs):
+    """Creates the service.
+
+    Args:
+      analysis_workers: Log entries analyzed concurrently.
+      storage_workers: Threads writing streamed uploads.
+      event_batch_size: Flight events inserted together.
+      event_flush_interval: Seconds a flight event may wait for its batch.
+      durable_events: Whether Notify acknowledges only after the event is
+        written, rather than as soon as it is queued.
+    """
+    super(FlightService, self).__init__(*args, **kwargs)
+    self._analyzer = analyzer.FlightDataAnalyzer()
+    # flight id -> (analysis session, last update time)
+    self._sessions = {}
+    self._sessions_lock = threading.Lock()
+    self._jobs = jobs.AnalysisJobQueue(
+        self._create_log_entry, workers=analysis_workers)
+    # Bounds concurrent Mongo writes of streamed uploads, however many
+    # aircraft are connected.
+    self._storage_executor = futures.ThreadPoolExecutor(
+        max_workers=storage_workers)
+    self._event_writer = bulk_writer.BulkWriter(
+        models.FlightEvent,
+        batch_size=event_batch_size,
+        flush_interval=event_flush_interval)
+    self._durable_events = durable_events
+
+  def start(self):
+    self._event_writer.start()
+    self._jobs.start()
+
+  def stop(self):
+    self._jobs.stop()
+    self._storage_executor.shutdown(wait=True)
+    self._event_writer.stop()
+
+  def get_event_writer_stats(self):
+    return self._event_writer.get_stats()
+
   def Notify(self, flight_event, context):
     self.logger.info('Notify flight event...(id={0}, event={1})'.format(
         flight_event.flight_id, flight_event.event_type))
@@ -18,7 +80,10 @@ class FlightService(flight_pb2_grpc.FlightServiceServicer, pattern.Logger):
     entry.flight_id = flight_event.flight_id
     entry.event_type = flight_event.event_type
     entry.timestamp = flight_event.timestamp
-    entry.save()
+    entry.validate()
+    error = self._event_writer.write(entry, wait=self._durable_events)
+    if error:
+      return flight_pb2.Receipt(succeed=False, message=error)
 
     return flight_pb2.Receipt(succeed=True)
 
@@ -27,63 +92,308 @@ class FlightService(flight_pb2_grpc.FlightServiceServicer, pattern.Logger):
         'Uploading flight data...(id={0}, index={1}, final={2})'.format(
             flight_data.id, flight_data.index, flight_data.final))
 
-    entry = None
-    if flight_data.index == 0:
-      if models.FlightData.objects(flight_id=flight_data.id).count() > 0:
-        return flight_pb2.Receipt(
-            succeed=False, message='Flight id already exist.')
-
-      entry = models.FlightData()
-      entry.flight_id = flight_data.id
-      entry.data = flight_data.data
-    else:
-      entry = models.FlightData.objects(flight_id=flight_data.id).first()
-      if not entry:
-        return flight_pb2.Receipt(
-            succeed=False,
-            message='Flight id {0} is not found.'.format(flight_data.id))
-      if entry.next_index != flight_data.index:
-        return flight_pb2.Receipt(
-            succeed=False,
-            message='Expect index {0} but received index {1}.'.format(
-                entry.next_index, flight_data.index))
-
-      entry.data += flight_data.data
-
-    if flight_data.final:
-      entry.next_index = -1
-      entry.status = models.FlightDataStatus.UPLOADED
-    else:
-      entry.next_index = flight_data.index + 1
-      entry.status = models.FlightDataStatus.UPLOADING
-    entry.last_update = datetime.datetime.utcnow()
-    entry.save()
+    try:
+      flight_storage.append_chunk(flight_data.id, flight_data.index,
+                                  flight_data.data, flight_data.final)
+    except flight_storage.FlightStorageException as e:
+      return flight_pb2.Receipt(succeed=False, message=str(e))
     self.logger.info('Flight data saved.')
 
+    self._analyze_chunk(flight_data)
     return flight_pb2.Receipt(succeed=True)
 
+  def UploadFlightDataStream(self, flight_data_iterator, context):
+    """Receives consecutive chunks of one flight on a single stream.
+
+    Ordering is validated as chunks arrive and they are stored in batches
+    on the storage executor, so the next batch is received while the
+    previous one is written. On failure, the message tells which chunks were
+    stored so the client can resume with the unary or streaming call from
+    there. Registered by add_streaming_handlers(); not part of flight.proto
+    yet.
+    """
+    flight_id = None
+    next_index = None
+    batch = []
+    batch_bytes = 0
+    stored = 0
+    # (future, number of chunks) of the batch being written.
+    pending = None
+    # Hash of the whole upload, known only if the stream starts at index 0.
+    content_hash = None
+
+    try:
+      for flight_data in flight_data_iterator:
+        if flight_id is None:
+          flight_id = flight_data.id
+          next_index = flight_data.index
+          if next_index == 0:
+            content_hash = hashlib.sha256()
+          self.logger.info(
+              'Streaming flight data...(id={0}, index={1})'.format(
+                  flight_id, next_index))
+        elif flight_data.id != flight_id:
+          raise flight_storage.FlightStorageException(
+              'Expect flight id {0} but received {1}.'.format(
+                  flight_id, flight_data.id))
+        elif flight_data.index != next_index:
+          raise flight_storage.FlightStorageException(
+              'Expect index {0} but received index {1}.'.format(
+                  next_index, flight_data.index))
+
+        batch.append(flight_data)
+        batch_bytes += len(flight_data.data)
+        next_index += 1
+        if content_hash:
+          content_hash.update(flight_data.data)
+        if flight_data.final:
+          break
+        if (len(batch) >= FlightService._STREAM_BATCH_CHUNKS or
+            batch_bytes >= FlightService._STREAM_BATCH_BYTES):
+          stored += self._wait_for_batch(pending)
+          pending = (self._storage_executor.submit(self._store_batch, batch,
+                                                   None), len(batch))
+          batch = []
+          batch_bytes = 0
+
+      stored += self._wait_for_batch(pending)
+      pending = None
+      if batch:
+        self._store_batch(batch, content_hash)
+        stored += len(batch)
+    except flight_storage.FlightStorageException as e:
+      return flight_pb2.Receipt(
+          succeed=False,
+          message='{0} Stored {1} chunk(s) of this stream.'.format(
+              str(e), stored))
+
+    finally:
+      if pending:
+        # Do not leave a write running behind a failed stream.
+        futures.wait([pending[0]])
+
+    self.logger.info('Flight data saved ({0} chunks).'.format(stored))
+    return flight_pb2.Receipt(succeed=True)
+
+  @staticmethod
+  def _wait_for_batch(pending):
+    if not pending:
+      return 0
+    (future, count) = pending
+    future.result()
+    return count
+
+  def _store_batch(self, batch, content_hash):
+    final = batch[-1].final
+    if content_hash and final:
+      content_hash = content_hash.hexdigest()
+    else:
+      content_hash = None
+    flight_storage.append_chunks(batch[0].id, batch[0].index,
+                                 [x.data for x in batch], final, content_hash)
+    for flight_data in batch:
+      self._analyze_chunk(flight_data)
+
+  def _analyze_chunk(self, flight_data):
+    now = time.time()
+    with self._sessions_lock:
+      self._expire_sessions(now)
+      (session, _) = self._sessions.pop(flight_data.id, (None, None))
+      if flight_data.index == 0:
+        if session:
+          session.close()
+        session = self._analyzer.start(flight_data.id)
+      elif not session or session.chunks != flight_data.index:
+        # Missed a chunk (e.g. after a restart); analyze from storage later.
+        if session:
+          session.close()
+        return
+      self._sessions[flight_data.id] = (session, now)
+
+    try:
+      session.feed(flight_data.data)
+    except Exception:
+      self.logger.exception(
+          'Failed to analyze chunk {0} of flight {1}.'.format(
+              flight_data.index, flight_data.id))
+      with self._sessions_lock:
+        self._sessions.pop(flight_data.id, None)
+      session.close()
+
+  def _expire_sessions(self, now):
+    expired = [
+        flight_id for flight_id, (_, last_update) in self._sessions.items()
+        if now - last_update > FlightService._SESSION_TIMEOUT_SECONDS
+    ]
+    for flight_id in expired:
+      self._sessions.pop(flight_id)[0].close()
+
+  def _analyze(self, flight_data, session):
+    if session:
+      try:
+        return session.finish()
+      except Exception:
+        self.logger.exception(
+            'Session of flight {0} failed; analyzing from storage.'.format(
+                flight_data.flight_id))
+    return self._analyzer.analyze(flight_data)
+
+  def _pop_session(self, flight_data):
+    """Removes the session of a flight; returns it if it was fed every
+    stored chunk of the completed upload, and closes it otherwise."""
+    with self._sessions_lock:
+      (session, _) = self._sessions.pop(flight_data.flight_id, (None, None))
+    if not session:
+      return None
+    if (flight_data.status != models.FlightDataStatus.UPLOADED or
+        flight_data.next_index != -1):
+      session.close()
+      return None
+    total_chunks = flight_storage.get_chunk_count(flight_data)
+    if session.chunks != total_chunks:
+      self.logger.warning(
+          'Session of flight {0} was fed {1} of {2} chunks; analyzing from '
+          'storage.'.format(flight_data.flight_id, session.chunks,
+                            total_chunks))
+      session.close()
+      return None
+    return session
+
   def CreateLogEntry(self, request, context):
-    self.logger.info('Creating log entry for flight {0}...'.format(request.id))
-    flight_data = models.FlightData.objects(flight_id=request.id).first()
-    if not flight_data:
-      raise Exception('Flight data {0} is not found.'.format(request.id))
+    """Creates the log entry of a flight and waits for it.
 
-    log_entry = analyzer.FlightDataAnalyzer().analyze(flight_data)
-    self.logger.info('Created log entry:\n{0}'.format(repr(log_entry)))
-    log_entry.save()
-    self.logger.info('Log entry saved.')
+    Analysis runs on the job queue like CreateLogEntryAsync, so the number
+    of concurrent analyses stays bounded however many requests wait here.
+    """
+    self.logger.info('Creating log entry for flight {0}...'.format(request.id))
+    job = self._jobs.wait(self._jobs.submit(request.id),
+                          context.time_remaining())
+    if job.status in (models.JobStatus.QUEUED, models.JobStatus.RUNNING):
+      raise Exception('Timed out waiting for job {0} of flight {1}.'.format(
+          job.id, request.id))
+    if job.status != models.JobStatus.SUCCEEDED:
+      raise Exception('Failed to create log entry for flight {0}: {1}'.format(
+          request.id, job.error))
 
+    log_entry = models.LogEntry.objects(id=job.log_entry_id).first()
+    summary = _summarize(log_entry)
     response = flight_pb2.CreateLogEntryResponse()
     response.succeed = True
-    response.departure_airport = log_entry.get_field_value(
-        essential.DepartureAirport.id())
-    response.arrival_airport = log_entry.get_field_value(
-        essential.ArrivalAirport.id())
-    response.route = log_entry.get_field_value(essential.Route.id())
-    response.total_time = log_entry.get_field_value(
-        essential.TotalTime.id()).total_seconds() / 3600.0
-    response.total_landings = log_entry.get_field_value(
-        essential.DayLanding.id(),
-        default_value=0) + log_entry.get_field_value(
-            essential.NightLanding.id(), default_value=0)
+    response.departure_airport = summary['departure_airport']
+    response.arrival_airport = summary['arrival_airport']
+    response.route = summary['route']
+    response.total_time = summary['total_time']
+    response.total_landings = summary['total_landings']
     return response
+
+  def CreateLogEntryAsync(self, request, context):
+    """Queues creation of the log entry of a flight.
+
+    Returns a receipt whose message is the job id to poll with
+    GetLogEntryJob.
+    """
+    job = self._jobs.submit(request.id)
+    self.logger.info('Queued job {0} for flight {1}.'.format(job.id,
+                                                            request.id))
+    return flight_pb2.Receipt(succeed=True, message=str(job.id))
+
+  def GetLogEntryJob(self, request, context):
+    """Returns the status of the job with id request.id.
+
+    The receipt succeeds once the job did, and its message is the job status
+    name, followed by the log entry id or the error, e.g. "RUNNING" or
+    "FAILED: Flight data ... is not found.". CreateLogEntry then returns the
+    summary of a succeeded job's log entry right away.
+    """
+    job = self._jobs.get(request.id)
+    if not job:
+      context.set_code(grpc.StatusCode.NOT_FOUND)
+      context.set_details('Job {0} is not found.'.format(request.id))
+      return flight_pb2.Receipt(succeed=False)
+
+    message = job.status.name
+    if job.status == models.JobStatus.SUCCEEDED:
+      message += ': {0}'.format(job.log_entry_id)
+    elif job.error:
+      message += ': {0}'.format(job.error)
+    return flight_pb2.Receipt(
+        succeed=job.status == models.JobStatus.SUCCEEDED, message=message)
+
+  def _create_log_entry(self, flight_id):
+    flight_data = models.FlightData.objects(flight_id=flight_id).first()
+    if not flight_data:
+      raise Exception('Flight data {0} is not found.'.format(flight_id))
+
+    # Popped and closed on every path, so the session of a flight whose log
+    # entry exists or whose analysis is cached is not left behind.
+    session = self._pop_session(flight_data)
+    try:
+      log_entry = models.LogEntry.objects(flight_id=flight_id).first()
+      if log_entry:
+        # Retried request.
+        self.logger.info('Log entry already exists.')
+      else:
+        log_entry = analysis_cache.get_log_entry(
+            flight_data, lambda: self._analyze(flight_data, session))
+        self.logger.info('Created log entry:\n{0}'.format(repr(log_entry)))
+        log_entry.save()
+        self.logger.info('Log entry saved.')
+    finally:
+      if session:
+        session.close()
+    return log_entry.id
+
+
+def _summarize(log_entry):
+  total_time = log_entry.get_field_value(essential.TotalTime.id())
+  return {
+      'departure_airport':
+          log_entry.get_field_value(essential.DepartureAirport.id()),
+      'arrival_airport':
+          log_entry.get_field_value(essential.ArrivalAirport.id()),
+      'route':
+          log_entry.get_field_value(essential.Route.id()),
+      'total_time':
+          total_time.total_seconds() / 3600.0 if total_time else 0.0,
+      'total_landings':
+          log_entry.get_field_value(essential.DayLanding.id(), default_value=0)
+          + log_entry.get_field_value(
+              essential.NightLanding.id(), default_value=0),
+  }
+
+
+def add_streaming_handlers(servicer, server):
+  """Registers RPCs of FlightService that flight.proto does not declare yet.
+
+  Clients call them by path, e.g. channel.stream_unary(
+  '/<package>.FlightService/UploadFlightDataStream', ...):
+    UploadFlightDataStream: stream of UploadFlightData requests -> Receipt.
+    CreateLogEntryAsync: CreateLogEntry request -> Receipt with the job id.
+    GetLogEntryJob: CreateLogEntry request with the job id -> Receipt with
+      the job status.
+  """
+  service = flight_pb2.DESCRIPTOR.services_by_name['FlightService']
+  # Requests reuse the messages of the declared RPCs.
+  flight_data_cls = getattr(
+      flight_pb2, service.methods_by_name['UploadFlightData'].input_type.name)
+  create_request_cls = getattr(
+      flight_pb2, service.methods_by_name['CreateLogEntry'].input_type.name)
+  handlers = {
+      'UploadFlightDataStream':
+          grpc.stream_unary_rpc_method_handler(
+              servicer.UploadFlightDataStream,
+              request_deserializer=flight_data_cls.FromString,
+              response_serializer=flight_pb2.Receipt.SerializeToString),
+      'CreateLogEntryAsync':
+          grpc.unary_unary_rpc_method_handler(
+              servicer.CreateLogEntryAsync,
+              request_deserializer=create_request_cls.FromString,
+              response_serializer=flight_pb2.Receipt.SerializeToString),
+      'GetLogEntryJob':
+          grpc.unary_unary_rpc_method_handler(
+              servicer.GetLogEntryJob,
+              request_deserializer=create_request_cls.FromString,
+              response_serializer=flight_pb2.Receipt.SerializeToString),
+  }
+  server.add_generic_rpc_handlers(
+      (grpc.method_handlers_generic_handler(service.full_name, handlers),))
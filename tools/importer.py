@@ -1,17 +1,70 @@
 import abc
+import argparse
 import datetime
+import enum
+import itertools
+import multiprocessing
+import os
 import threading
-import time
 import sys
-import Queue
 
+import mongoengine
+from concurrent import futures
+
+from onelog.core import bulk_writer
 from onelog.core import engine
 from onelog.core import essential
 from onelog.core import loader
 from onelog.core import models
+from onelog.core import profiling
+from onelog.core import reference
+
+_worker_state = {}
+
+
+def _connect_worker():
+	# Each worker process gets its own Mongo connection rather than sharing
+	# the one inherited through fork.
+	if _worker_state.get('pid') != os.getpid():
+		mongoengine.connection.disconnect()
+		mongoengine.connect('onelog')
+		_worker_state['pid'] = os.getpid()
+
+
+def parse_range(importer_type, start, end, raw=False):
+	"""Parses a byte range of an importer's file in a worker process."""
+	_connect_worker()
+	importer = importer_type(commit=False)
+	importer.set_raw(raw)
+	return importer.parse_range(start, end)
+
+
+def _to_bson(value):
+	# Converts as the mongoengine fields of the imported models would.
+	if isinstance(value, enum.Enum):
+		return value.value
+	if isinstance(value, dict):
+		return dict((k, _to_bson(v)) for k, v in value.iteritems())
+	if isinstance(value, datetime.datetime):
+		return value
+	if isinstance(value, datetime.date):
+		return datetime.datetime.combine(value, datetime.time.min)
+	if isinstance(value, datetime.timedelta):
+		return value.total_seconds()
+	return value
+
 
 class DataImporter(loader.DataLoader):
-	MAX_COMMIT_SIZE = 10000
+	BATCH_SIZE = 1000
+	FLUSH_INTERVAL = 1.0
+	WRITERS = 4
+	MAX_QUEUE_SIZE = 20000
+	# In raw mode, one in this many rows is validated against the model.
+	RAW_VALIDATION_INTERVAL = 1000
+	PARALLEL_RANGE_SIZE = 4*1024*1024
+	# Whether each row parses on its own, so byte ranges can be parsed by
+	# separate processes.
+	PARALLEL = True
 
 	def __init__(self, kind, model, filename, delimiter=',', commit=True):
 		super(DataImporter, self).__init__(filename, delimiter)
@@ -19,26 +72,70 @@ class DataImporter(loader.DataLoader):
 		self._kind = kind
 		self._model = model
 		self._commit = commit
-		self._queue = Queue.Queue(DataImporter.MAX_COMMIT_SIZE*2)
+		self._writer = None
+		self._raw = False
 		self._total_read = 0
 		self._total_parsed = 0
-		self._total_imported = 0
+		self._total_validated = 0
+		self._total_invalid = 0
+		# Added to the row count to pick the rows validated in raw mode.
+		self._sample_offset = 0
 
 		cls = type(self)
 		self._field_names = [x for x in dir(cls) if isinstance(getattr(cls, x), loader.DataColumn) and not x.startswith('_')]
+		fields = self._model._fields
+		self._db_fields = dict((x, fields[x].db_field) for x in self._field_names if x in fields)
+
+	@property
+	def raw_supported(self):
+		# Raw rows skip parse(), so importers building their own documents
+		# cannot use them.
+		return type(self).parse.__func__ is DataImporter.parse.__func__
+
+	def set_raw(self, raw):
+		"""Sets whether rows are imported as plain dicts instead of documents.
+
+		Raw rows are converted straight from the columns and inserted without
+		mongoengine. Only one in RAW_VALIDATION_INTERVAL rows is validated
+		against the model; the others are inserted unchecked.
+		"""
+		if raw and not self.raw_supported:
+			raise DataImporterException('{0} rows cannot be imported raw.'.format(self._kind))
+		self._raw = raw
+		self._raw_containers = raw
 
 	def reset(self):
 		if self._commit:
 			print('Deleting existing %s data...' % (self._kind))
 			self._model.drop_collection()
+			reference.invalidate(self._model)
+
+	def load(self, workers=None, writers=None, batch_size=None, flush_interval=None, raw=False):
+		"""Parses and imports every row.
+
+		Parsed documents are inserted by writer threads in unordered batches of
+		`batch_size`, or smaller ones after `flush_interval` seconds. Parsing
+		blocks while MAX_QUEUE_SIZE documents wait to be inserted.
 
-	def load(self):
+		Args:
+			workers: Number of processes parsing byte ranges of the file. Rows are
+				parsed in this process if not set.
+			writers: Number of threads inserting batches.
+			raw: Whether to import rows as plain dicts; see set_raw().
+		"""
+		if workers and not type(self).PARALLEL:
+			raise DataImporterException('{0} rows cannot be parsed in parallel.'.format(self._kind))
+		self.set_raw(raw)
 
 		if self._commit:
-			load_complete = threading.Event()
-			import_thread = threading.Thread(target=self._import_data, args=(load_complete,))
-			import_thread.daemon = True
-			import_thread.start()
+			self._writer = bulk_writer.BulkWriter(
+				self._model,
+				batch_size=batch_size or DataImporter.BATCH_SIZE,
+				flush_interval=flush_interval or DataImporter.FLUSH_INTERVAL,
+				writers=writers or DataImporter.WRITERS,
+				max_queue_size=DataImporter.MAX_QUEUE_SIZE,
+				prepare=None if raw else self.prepare)
+			self._writer.start()
 
 		import_complete = threading.Event()
 		monitor_thread = threading.Thread(target=self._show_progress, args=(import_complete,))
@@ -46,24 +143,92 @@ class DataImporter(loader.DataLoader):
 		monitor_thread.start()
 
 		try:
-			super(DataImporter, self).load(self.on_data)
+			if workers:
+				self._load_parallel(workers)
+			else:
+				super(DataImporter, self).load(self.on_data)
 		finally:
 			if self._commit:
-				load_complete.set()
-				import_thread.join()
+				self._writer.stop()
+				reference.invalidate(self._model)
 			import_complete.set()
 			monitor_thread.join()
 
 	def on_data(self, _):
 		self._total_read +=1
-		doc = self.parse()
+		doc = self._parse_row()
 		if doc:
 			self._total_parsed += 1
 		else:
 			#print 'Line {0} is dropped.'.format(self.line_number)
 			pass
 		if doc and self._commit:
-			self._queue.put(doc, block=True)
+			self._writer.write(doc)
+
+	def parse_range(self, start, end):
+		"""Parses the rows in a byte range of the file without importing them.
+
+		Returns:
+			(parsed documents, rows read, rows dropped by errors, rows validated,
+			rows dropped by validation).
+		"""
+		docs = []
+		self.select_range(start, end)
+		# Ranges each sample one row in RAW_VALIDATION_INTERVAL, starting at
+		# different rows rather than always at their first one.
+		self._sample_offset = start
+		with self:
+			while self.next():
+				self._total_read += 1
+				doc = self._parse_row()
+				if doc:
+					docs.append(doc)
+		return (docs, self._total_read, self.total_error, self._total_validated,
+			self._total_invalid)
+
+	def _load_parallel(self, workers):
+		ranges = iter(loader.split_byte_ranges(
+			self._filename, DataImporter.PARALLEL_RANGE_SIZE, self._delimiter))
+		executor = futures.ProcessPoolExecutor(max_workers=workers)
+		try:
+			# Only a couple of ranges per worker are submitted ahead, so parsed
+			# documents wait in the writer queue rather than in finished futures.
+			running = {}
+			for start, end in itertools.islice(ranges, workers*2):
+				running[executor.submit(parse_range, type(self), start, end, self._raw)] = end - start
+			while running:
+				done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+				for future in done:
+					size = running.pop(future)
+					docs, total_read, total_error, total_validated, total_invalid = future.result()
+					self._total_read += total_read
+					self._total_error += total_error
+					self._total_validated += total_validated
+					self._total_invalid += total_invalid
+					self._read_size += size
+					for doc in docs:
+						self._total_parsed += 1
+						if self._commit:
+							self._writer.write(doc)
+					for start, end in itertools.islice(ranges, 1):
+						running[executor.submit(parse_range, type(self), start, end, self._raw)] = end - start
+		finally:
+			executor.shutdown(wait=True)
+
+	def _parse_row(self):
+		if not self._raw:
+			return self.parse()
+
+		doc = self.parse_raw()
+		if (self._total_read + self._sample_offset) % DataImporter.RAW_VALIDATION_INTERVAL == 0:
+			self._total_validated += 1
+			try:
+				self._model._from_son(doc).validate()
+			except mongoengine.ValidationError as e:
+				self._total_invalid += 1
+				print('\nLine {0} is invalid: {1}'.format(self.line_number, e))
+				return None
+		return doc
 
 	def parse(self):
 		doc = self._model()
@@ -72,18 +237,21 @@ class DataImporter(loader.DataLoader):
 			setattr(doc, field_name, value)
 		return doc
 
-	def _import_data(self, complete_signal):
-		while not complete_signal.is_set() or not self._queue.empty():
-			while not complete_signal.is_set() and self._queue.qsize() < DataImporter.MAX_COMMIT_SIZE/3:
-				time.sleep(0.5)
+	def parse_raw(self):
+		"""Returns the current row as a dict ready to be inserted with pymongo.
 
-			buffer = []
-			while not self._queue.empty() and len(buffer) < DataImporter.MAX_COMMIT_SIZE:
-				buffer.append(self._queue.get())
-			if buffer:
-				self._model.objects.insert(buffer, load_bulk=False)
-				self._total_imported += len(buffer)
+		Like Document.to_mongo(), empty values are left out.
+		"""
+		doc = {}
+		for field_name, value in self.row:
+			db_field = self._db_fields.get(field_name)
+			if db_field and value is not None:
+				doc[db_field] = _to_bson(value)
+		return doc
 
+	def prepare(self, docs):
+		# Called with each batch of parsed documents right before it is inserted.
+		pass
 
 	def _show_progress(self, complete_signal):
 		start = datetime.datetime.now()
@@ -91,16 +259,28 @@ class DataImporter(loader.DataLoader):
 			total_seconds = (datetime.datetime.now() - start).total_seconds()
 			msg = '\r{0:.0f}% Done (queue={1}) ({2:.2f} entities/sec)   '.format(
 				self.progress*100,
-				self._queue.qsize(),
+				self._writer.get_stats()['queue_depth'] if self._writer else 0,
 				self._total_parsed/total_seconds if total_seconds>0 else 0)
 			sys.stdout.write(msg)
 			sys.stdout.flush()
-			time.sleep(1)
+			complete_signal.wait(1)
 
 		print('')
 		print('Total read: {0}'.format(self._total_read))
 		print('Total parsed: {0}'.format(self._total_parsed))
-		print('Total imported: {0}'.format(self._total_imported))
+		if self._raw:
+			print('Total validated: {0} sampled rows (1 in {1}), {2} invalid; other rows were not validated'.format(
+				self._total_validated, DataImporter.RAW_VALIDATION_INTERVAL, self._total_invalid))
+		if self._writer:
+			stats = self._writer.get_stats()
+			print('Total imported: {0}'.format(stats['written']))
+			print('Total failed: {0}'.format(stats['failed']))
+			if stats['batches']:
+				print('Batches: {0} (avg size {1:.0f}, insert ms avg={2:.1f} p50={3:.1f} p95={4:.1f} max={5:.1f})'.format(
+					stats['batches'], stats['avg_batch_size'], stats['avg_flush_ms'],
+					stats['p50_flush_ms'], stats['p95_flush_ms'], stats['max_flush_ms']))
+		else:
+			print('Total imported: 0')
 
 
 class DataImporterException(Exception):
@@ -222,6 +402,9 @@ def airman_unique_id_normalizer(id):
 	return str(ord(id[0]) - ord('A')) + id[1:]
 
 class AirmanImporter(DataImporter):
+	# Certificates are merged from a second file sorted by the same id.
+	PARALLEL = False
+
 	unique_id = loader.IntColumn('UNIQUE ID', preprocessor = airman_unique_id_normalizer)
 	first_name = loader.StringColumn('FIRST NAME')
 	last_name = loader.StringColumn('LAST NAME')
@@ -353,6 +536,10 @@ def approach_loader(str):
 
 
 class LogTenProImporter(DataImporter):
+	# People are looked up in Mongo for every row, and lookup errors are
+	# swallowed; a small export gains nothing from worker processes.
+	PARALLEL = False
+
 	date = loader.DateTimeColumn('Date', fmt='%Y-%m-%d')
 	tail_number = loader.StringColumn('Aircraft ID')
 	departure_airport = loader.StringColumn('From')
@@ -492,13 +679,37 @@ class LogTenProImporter(DataImporter):
 		entry.created_at = datetime.datetime.now()
 		entry.last_modified_at = entry.created_at
 
-		self._compute_engine.compute(entry)
-
-
 		return entry
 
+	def prepare(self, docs):
+		self._compute_engine.compute_many(
+			x for x in docs if x.type == models.LogEntryType.FLIGHT)
+
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Import FAA data and logbooks.')
+	parser.add_argument('--workers', type=int, default=None,
+		help='Number of processes parsing the data files, one per core if 0. '
+		'Files are parsed in the importing process if omitted.')
+	parser.add_argument('--writers', type=int, default=DataImporter.WRITERS,
+		help='Number of threads inserting into Mongo.')
+	parser.add_argument('--batch-size', type=int, default=DataImporter.BATCH_SIZE,
+		help='Documents inserted together.')
+	parser.add_argument('--flush-ms', type=int, default=int(DataImporter.FLUSH_INTERVAL*1000),
+		help='Max time a parsed document waits for its batch.')
+	parser.add_argument('--raw', action='store_true',
+		help='Insert rows as plain dicts, validating only a sample, where the '
+		'importer supports it.')
+	parser.add_argument('--profile', action='store_true',
+		help='Print per field type compute stats after the import.')
+	args = parser.parse_args()
+
+	profiler = None
+	if args.profile:
+		profiling.install()
+		profiler = profiling.Profiler()
+		engine.set_default_profiler(profiler)
+
 	importer_types = [
 		#EngineDataImporter,
 		#AircraftModelImporter,
@@ -510,4 +721,15 @@ if __name__ == "__main__":
 	for importer_type in importer_types:
 		with importer_type(commit=True) as importer:
 			importer.reset()
-			importer.load()
+			workers = args.workers
+			if workers == 0:
+				workers = multiprocessing.cpu_count()
+			importer.load(
+				workers=workers if importer_type.PARALLEL else None,
+				writers=args.writers,
+				batch_size=args.batch_size,
+				flush_interval=args.flush_ms/1000.0,
+				raw=args.raw and importer.raw_supported)
+
+	if profiler:
+		print(profiler.format_report())
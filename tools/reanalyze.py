@@ -0,0 +1,230 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import mongoengine
+from concurrent import futures
+from pymongo import UpdateOne
+
+from onelog.core import analyzer
+from onelog.core import engine
+from onelog.core import models
+from onelog.core import profiling
+from onelog.core import reference
+
+_worker_state = {}
+
+
+def _get_worker_state():
+	# Each worker process gets its own Mongo connection, analyzer, compute
+	# engine and airport index (built once per process by core/reference).
+	if _worker_state.get('pid') != os.getpid():
+		mongoengine.connection.disconnect()
+		mongoengine.connect('onelog')
+		reference.get_airport_index()
+		_worker_state['pid'] = os.getpid()
+		_worker_state['analyzer'] = analyzer.FlightDataAnalyzer()
+		_worker_state['engine'] = engine.ComputeEngine()
+	return _worker_state
+
+
+def _merge(stored, log_entry, compute_engine):
+	"""Replaces the recorded fields of a stored entry with a new analysis.
+
+	User-entered fields are kept, and derived fields are recomputed from the
+	merged inputs.
+	"""
+	recorded = set(x.id() for x in analyzer.RECORDED_FIELD_TYPES)
+	stored.data_fields = [
+		x for x in stored.data_fields or []
+		if x.airman_id or x.type_id not in recorded
+	] + [
+		x for x in log_entry.data_fields
+		if not x.airman_id and x.type_id in recorded
+	]
+	stored.timestamp = log_entry.timestamp
+	compute_engine.recompute(stored)
+
+
+def _to_update(log_entry, stored, compute_engine):
+	if stored:
+		_merge(stored, log_entry, compute_engine)
+		doc = stored.to_mongo()
+		return UpdateOne({'_id': stored.id}, {'$set': {
+			'timestamp': doc.get('timestamp'),
+			'data_fields': doc.get('data_fields', []),
+			'last_modified_at': log_entry.last_modified_at,
+		}})
+
+	doc = log_entry.to_mongo()
+	return UpdateOne({'flight_id': log_entry.flight_id}, {
+		'$set': {
+			'type': doc['type'],
+			'timestamp': doc.get('timestamp'),
+			'data_fields': doc.get('data_fields', []),
+			'last_modified_at': doc['last_modified_at'],
+		},
+		'$setOnInsert': {
+			'flight_id': log_entry.flight_id,
+			'created_at': doc['created_at'],
+		},
+	}, upsert=True)
+
+
+def analyze_batch(flight_ids, commit=True):
+	"""Re-analyzes the given flights and upserts their log entries.
+
+	Returns:
+		List of (flight id, seconds, error message or None).
+	"""
+	state = _get_worker_state()
+	stored_entries = dict(
+		(x.flight_id, x) for x in models.LogEntry.objects(flight_id__in=flight_ids))
+	timings = []
+	updates = []
+	for flight_id in flight_ids:
+		start = profiling.timer()
+		try:
+			flight_data = models.FlightData.objects(flight_id=flight_id).first()
+			if not flight_data:
+				raise Exception('Flight data {0} is not found.'.format(flight_id))
+			updates.append(_to_update(state['analyzer'].analyze(flight_data),
+				stored_entries.get(flight_id), state['engine']))
+			error = None
+		except Exception as e:
+			error = str(e) or type(e).__name__
+		timings.append((flight_id, profiling.timer() - start, error))
+
+	if updates and commit:
+		models.LogEntry._get_collection().bulk_write(updates, ordered=False)
+	return timings
+
+
+class FlightReanalyzer(object):
+	"""Re-runs FlightDataAnalyzer over stored flights across a process pool."""
+
+	def __init__(self, statuses=None, since=None, until=None, batch_size=10, workers=None,
+			commit=True):
+		self._statuses = statuses
+		self._since = since
+		self._until = until
+		self._batch_size = batch_size
+		self._workers = workers or multiprocessing.cpu_count()
+		self._commit = commit
+		self._total = 0
+		self._timings = []
+
+	@property
+	def timings(self):
+		return self._timings
+
+	def run(self):
+		flight_ids = list(self._query().order_by('last_update').scalar('flight_id'))
+		self._total = len(flight_ids)
+
+		complete = threading.Event()
+		monitor_thread = threading.Thread(target=self._show_progress, args=(complete,))
+		monitor_thread.daemon = True
+		monitor_thread.start()
+
+		executor = futures.ProcessPoolExecutor(max_workers=self._workers)
+		try:
+			batches = [flight_ids[i:i + self._batch_size]
+				for i in range(0, len(flight_ids), self._batch_size)]
+			running = [executor.submit(analyze_batch, x, self._commit) for x in batches]
+			for future in futures.as_completed(running):
+				self._timings.extend(future.result())
+		finally:
+			executor.shutdown(wait=True)
+			complete.set()
+			monitor_thread.join()
+
+	def _query(self):
+		query = models.FlightData.objects
+		if self._statuses:
+			query = query.filter(status__in=[x.value for x in self._statuses])
+		if self._since:
+			query = query.filter(last_update__gte=self._since)
+		if self._until:
+			query = query.filter(last_update__lt=self._until)
+		return query
+
+	def _show_progress(self, complete_signal):
+		start = datetime.datetime.now()
+		while not complete_signal.is_set():
+			total_seconds = (datetime.datetime.now() - start).total_seconds()
+			done = len(self._timings)
+			msg = '\r{0:.0f}% Done ({1:.2f} flights/sec)   '.format(
+				float(done) * 100 / self._total if self._total else 100,
+				done / total_seconds if total_seconds > 0 else 0)
+			sys.stdout.write(msg)
+			sys.stdout.flush()
+			time.sleep(1)
+		print('')
+
+	def format_report(self, top=10):
+		seconds = sorted(x[1] for x in self._timings)
+		failed = [x for x in self._timings if x[2]]
+		lines = ['Total {0}: {1}'.format(
+			'analyzed' if self._commit else 'analyzed (dry run)', len(self._timings))]
+		lines.append('Failed: {0}'.format(len(failed)))
+		if seconds:
+			lines.append('Seconds per flight: mean={0:.3f} p50={1:.3f} p95={2:.3f} max={3:.3f}'.format(
+				sum(seconds) / len(seconds), seconds[len(seconds) // 2],
+				seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))], seconds[-1]))
+			lines.append('Slowest flights:')
+			for flight_id, flight_seconds, _ in sorted(
+					self._timings, key=lambda x: x[1], reverse=True)[:top]:
+				lines.append('  {0:<40} {1:>10.3f}s'.format(flight_id, flight_seconds))
+		for flight_id, _, error in failed:
+			lines.append('  {0:<40} FAILED: {1}'.format(flight_id, error))
+		return '\n'.join(lines)
+
+	def write_timings(self, path):
+		with open(path, 'w') as f:
+			f.write('flight_id\tseconds\terror\n')
+			for flight_id, seconds, error in self._timings:
+				f.write('{0}\t{1:.6f}\t{2}\n'.format(flight_id, seconds, error or ''))
+
+
+def _parse_date(value):
+	return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Re-analyze stored flight data into log entries.')
+	parser.add_argument('--status', nargs='*', default=[models.FlightDataStatus.UPLOADED.name],
+		choices=[x.name for x in models.FlightDataStatus],
+		help='Statuses of flight data to analyze.')
+	parser.add_argument('--since', type=_parse_date,
+		help='Only flights last updated on or after this date (YYYY-MM-DD).')
+	parser.add_argument('--until', type=_parse_date,
+		help='Only flights last updated before this date (YYYY-MM-DD).')
+	parser.add_argument('--batch-size', type=int, default=10)
+	parser.add_argument('--workers', type=int, default=None,
+		help='Number of worker processes, one per core if omitted.')
+	parser.add_argument('--dry-run', action='store_true',
+		help='Analyze and report without writing log entries.')
+	parser.add_argument('--timings',
+		help='File to write per-flight timings to (tab separated).')
+	args = parser.parse_args()
+
+	reanalyzer = FlightReanalyzer(
+		statuses=[models.FlightDataStatus[x] for x in args.status],
+		since=args.since,
+		until=args.until,
+		batch_size=args.batch_size,
+		workers=args.workers,
+		commit=not args.dry_run)
+	reanalyzer.run()
+	print(reanalyzer.format_report())
+	if args.timings:
+		reanalyzer.write_timings(args.timings)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import mongoengine
+from bson import objectid
+from concurrent import futures
+from pymongo import UpdateOne
+
+from onelog.core import engine
+from onelog.core import models
+
+# To trigger registering
+from onelog.core import essential
+
+_worker_state = {}
+
+
+def _batches(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		batch = list(itertools.islice(iterator, size))
+		if not batch:
+			return
+		yield batch
+
+
+def _get_worker_engine():
+	# Each worker process gets its own Mongo connection, compute engine and,
+	# through core/reference, its own reference data caches.
+	if _worker_state.get('pid') != os.getpid():
+		mongoengine.connection.disconnect()
+		mongoengine.connect('onelog')
+		_worker_state['pid'] = os.getpid()
+		_worker_state['engine'] = engine.ComputeEngine()
+	return _worker_state['engine']
+
+
+def get_field_types(names):
+	field_types = dict((x.name, type(x)) for x in models.LogEntryFieldTypeFactory.get_all())
+	unknown = [x for x in names if x not in field_types]
+	if unknown:
+		raise ValueError('Unknown field types: {0}'.format(', '.join(unknown)))
+	return [field_types[x] for x in names]
+
+
+def _dump_fields(entry):
+	return [x.to_mongo() for x in entry.data_fields or []]
+
+
+def recompute_batch(ids, field_type_names=None, commit=True, mark_derived=False):
+	"""Recomputes derived fields of the given entries and writes back changes.
+
+	Fields stored before LogEntryField.derived existed count as user-entered
+	unless `mark_derived` is set. Entries whose stored fields end up the same
+	are not written.
+
+	Args:
+		mark_derived: Whether to flag legacy fields first, see
+			ComputeEngine.mark_derived().
+
+	Returns:
+		(total read, total with legacy fields, total updated)
+	"""
+	compute_engine = _get_worker_engine()
+	field_types = get_field_types(field_type_names) if field_type_names else None
+	entries = list(models.LogEntry.objects(id__in=ids))
+	before = dict((x.id, _dump_fields(x)) for x in entries)
+	legacy = [x for x in entries if any(f.derived is None for f in x.data_fields or [])]
+	if mark_derived:
+		for entry in legacy:
+			compute_engine.mark_derived(entry)
+	compute_engine.recompute_many(entries, field_types)
+
+	now = datetime.datetime.utcnow()
+	updates = []
+	for entry in entries:
+		data_fields = _dump_fields(entry)
+		if data_fields == before[entry.id]:
+			continue
+		updates.append(UpdateOne({'_id': entry.id}, {'$set': {
+			'data_fields': data_fields,
+			'last_modified_at': now,
+		}}))
+	if updates and commit:
+		models.LogEntry._get_collection().bulk_write(updates, ordered=False)
+
+	return (len(entries), len(legacy), len(updates))
+
+
+class LogbookRecomputer(object):
+	"""Recomputes derived fields of every flight across a process pool.
+
+	Entry ids are streamed from Mongo in id order and handed out in batches.
+	The id of the last batch below which everything has completed is saved
+	to the checkpoint file, so an interrupted run resumes from there.
+	"""
+
+	def __init__(self, field_type_names=None, batch_size=500, workers=None, commit=True,
+			checkpoint=None, mark_derived=False):
+		self._field_type_names = field_type_names
+		self._mark_derived = mark_derived
+		self._batch_size = batch_size
+		self._workers = workers or multiprocessing.cpu_count()
+		self._commit = commit
+		self._checkpoint = checkpoint
+		self._total = 0
+		self._total_read = 0
+		self._total_legacy = 0
+		self._total_updated = 0
+		self._pending = 0
+
+	def run(self):
+		query = models.LogEntry.objects(type=models.LogEntryType.FLIGHT)
+		last_id = self._load_checkpoint()
+		if last_id:
+			print('Resuming after {0}...'.format(last_id))
+			query = query.filter(id__gt=last_id)
+		self._total = query.count()
+
+		complete = threading.Event()
+		monitor_thread = threading.Thread(target=self._show_progress, args=(complete,))
+		monitor_thread.daemon = True
+		monitor_thread.start()
+
+		try:
+			ids = query.order_by('id').scalar('id')
+			self._run_batches(_batches(ids, self._batch_size))
+		finally:
+			complete.set()
+			monitor_thread.join()
+
+	def _run_batches(self, batches):
+		executor = futures.ProcessPoolExecutor(max_workers=self._workers)
+		# (last id of batch, future) in submission order.
+		submitted = []
+		try:
+			for batch in batches:
+				running = [x[1] for x in submitted if not x[1].done()]
+				if len(running) >= self._workers * 2:
+					futures.wait(running, return_when=futures.FIRST_COMPLETED)
+				submitted = self._collect(submitted)
+				submitted.append(
+					(batch[-1], executor.submit(
+						recompute_batch, batch, self._field_type_names, self._commit,
+						self._mark_derived)))
+				self._pending = len(submitted)
+			futures.wait([x[1] for x in submitted])
+			self._collect(submitted)
+		finally:
+			executor.shutdown(wait=True)
+
+	@staticmethod
+	def _completed_prefix(submitted):
+		count = 0
+		for _, future in submitted:
+			if not future.done():
+				break
+			count += 1
+		return count
+
+	def _collect(self, submitted):
+		# Only a completed prefix is collected, so the checkpoint never skips
+		# a batch that is still running.
+		count = self._completed_prefix(submitted)
+		for last_id, future in submitted[:count]:
+			(total_read, total_legacy, total_updated) = future.result()
+			self._total_read += total_read
+			self._total_legacy += total_legacy
+			self._total_updated += total_updated
+			self._save_checkpoint(last_id)
+		self._pending = len(submitted) - count
+		return submitted[count:]
+
+	def _load_checkpoint(self):
+		if not self._checkpoint or not os.path.exists(self._checkpoint):
+			return None
+		with open(self._checkpoint) as f:
+			value = f.read().strip()
+		return objectid.ObjectId(value) if value else None
+
+	def _save_checkpoint(self, last_id):
+		if not self._checkpoint or not self._commit:
+			return
+		with open(self._checkpoint, 'w') as f:
+			f.write(str(last_id))
+
+	def _show_progress(self, complete_signal):
+		start = datetime.datetime.now()
+		while not complete_signal.is_set():
+			total_seconds = (datetime.datetime.now() - start).total_seconds()
+			msg = '\r{0:.0f}% Done (pending={1}) ({2:.2f} entities/sec)   '.format(
+				float(self._total_read) * 100 / self._total if self._total else 100,
+				self._pending,
+				self._total_read / total_seconds if total_seconds > 0 else 0)
+			sys.stdout.write(msg)
+			sys.stdout.flush()
+			time.sleep(1)
+
+		print('')
+		print('Total read: {0}'.format(self._total_read))
+		if self._mark_derived:
+			print('Total with legacy fields flagged: {0}'.format(self._total_legacy))
+		else:
+			print('Total with unflagged legacy fields (see --mark-derived): {0}'.format(
+				self._total_legacy))
+		print('Total {0}: {1}'.format(
+			'updated' if self._commit else 'to update (dry run)', self._total_updated))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Recompute derived fields of the whole logbook.')
+	parser.add_argument('--field-types', nargs='*',
+		help='Names of field types whose rules changed; all derived fields if omitted.')
+	parser.add_argument('--batch-size', type=int, default=500)
+	parser.add_argument('--workers', type=int, default=None,
+		help='Number of worker processes, one per core if omitted.')
+	parser.add_argument('--dry-run', action='store_true',
+		help='Compute and report without writing back.')
+	parser.add_argument('--mark-derived', action='store_true',
+		help='Flag fields stored before derived fields were recorded, so they '
+		'are recomputed too. Otherwise they are kept as user-entered.')
+	parser.add_argument('--checkpoint', default='recompute.checkpoint',
+		help='File recording progress; an existing one resumes the run.')
+	args = parser.parse_args()
+
+	if args.field_types:
+		get_field_types(args.field_types)
+
+	recomputer = LogbookRecomputer(
+		field_type_names=args.field_types,
+		batch_size=args.batch_size,
+		workers=args.workers,
+		commit=not args.dry_run,
+		checkpoint=args.checkpoint,
+		mark_derived=args.mark_derived)
+	recomputer.run()
+	if not args.dry_run and os.path.exists(args.checkpoint):
+		os.remove(args.checkpoint)
+
+
+if __name__ == '__main__':
+	main()
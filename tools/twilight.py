@@ -0,0 +1,30 @@
+import argparse
+import datetime
+import sys
+
+from onelog.core import models
+from onelog.util import utility
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description='Precompute yearly civil twilight tables for NightTime.')
+	parser.add_argument('--years', type=int, nargs='+', default=[datetime.date.today().year])
+	parser.add_argument('--airports', nargs='*', help='ICAO ids, all airports if omitted.')
+	args = parser.parse_args()
+
+	airports = models.Airport.objects(airport_type=models.AirportType.AIRPORT)
+	if args.airports:
+		airports = airports.filter(icao_id__in=args.airports)
+
+	total = airports.count()
+	for i, airport in enumerate(airports):
+		sys.stdout.write('\r{0}/{1} {2:<8}'.format(i + 1, total, airport.icao_id))
+		sys.stdout.flush()
+		for year in args.years:
+			utility.write_civil_twilight_table(airport.icao_id, year, airport.geolocation)
+	print('')
+
+
+if __name__ == '__main__':
+	main()
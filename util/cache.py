@@ -0,0 +1,85 @@
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+  """Thread-safe read-through LRU cache with optional per-entry TTL.
+
+  Missing values (loader returned None) are cached too, so repeated lookups
+  of unknown keys do not hit the backing store again.
+  """
+
+  def __init__(self, name, max_size=1024, ttl=None):
+    self._name = name
+    self._max_size = max_size
+    self._ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  @property
+  def name(self):
+    return self._name
+
+  def get(self, key, loader):
+    now = time.time()
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None and (entry[1] is None or entry[1] > now):
+        self._entries[key] = entry
+        self._hits += 1
+        return entry[0]
+      self._misses += 1
+
+    value = loader(key)
+    self.put(key, value)
+    return value
+
+  def missing(self, keys):
+    """Returns the keys that have no live entry."""
+    now = time.time()
+    with self._lock:
+      result = []
+      for key in keys:
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+          result.append(key)
+      return result
+
+  def put(self, key, value):
+    expire_at = time.time() + self._ttl if self._ttl else None
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, expire_at)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+        self._evictions += 1
+
+  def invalidate(self, key=None):
+    with self._lock:
+      if key is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(key, None)
+
+  def get_stats(self):
+    with self._lock:
+      total = self._hits + self._misses
+      return {
+          'name': self._name,
+          'size': len(self._entries),
+          'max_size': self._max_size,
+          'hits': self._hits,
+          'misses': self._misses,
+          'evictions': self._evictions,
+          'hit_rate': float(self._hits) / total if total else None,
+      }
+
+  def reset_stats(self):
+    with self._lock:
+      self._hits = 0
+      self._misses = 0
+      self._evictions = 0
@@ -0,0 +1,114 @@
+import collections
+import math
+
+# Same as MongoDB uses for spherical distances.
+EARTH_RADIUS_METERS = 6378100.0
+
+
+def _to_unit_vector(lon, lat):
+  lon = math.radians(lon)
+  lat = math.radians(lat)
+  return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon),
+          math.sin(lat))
+
+
+class GeoGridIndex(object):
+  """In-memory nearest-neighbor index of points on the earth.
+
+  Points are bucketed into a lat/lon grid and compared by chord length
+  between unit vectors, which orders them the same as great-circle
+  distance without any trigonometry per candidate.
+  """
+
+  def __init__(self, items, cell_degrees=0.25):
+    """Builds the index.
+
+    Args:
+      items: Iterable of (lon, lat, value).
+      cell_degrees: Size of a grid cell in degrees.
+    """
+    self._cell_degrees = cell_degrees
+    self._cells = collections.defaultdict(list)
+    self._size = 0
+    for lon, lat, value in items:
+      self._cells[self._cell(lon, lat)].append(
+          (_to_unit_vector(lon, lat), value))
+      self._size += 1
+
+  def __len__(self):
+    return self._size
+
+  def _cell(self, lon, lat):
+    return (int(math.floor(lat / self._cell_degrees)),
+            int(math.floor(lon / self._cell_degrees)))
+
+  @property
+  def cell_degrees(self):
+    return self._cell_degrees
+
+  def nearest(self, lon, lat, max_distance):
+    """Returns the value nearest to (lon, lat) within max_distance meters."""
+    (x, y, z) = _to_unit_vector(lon, lat)
+    best = None
+    best_distance = max_chord_squared(max_distance)
+    for (px, py, pz), value in self.candidates(lon, lat, lon, lat,
+                                               max_distance):
+      distance = (px - x)**2 + (py - y)**2 + (pz - z)**2
+      if distance <= best_distance:
+        best = value
+        best_distance = distance
+    return best
+
+  def candidates(self, lon_min, lat_min, lon_max, lat_max, max_distance):
+    """Returns points that may lie within max_distance meters of a box.
+
+    Each point is a (unit vector, value) tuple.
+    """
+    lat_span = math.degrees(min(max_distance / EARTH_RADIUS_METERS, math.pi))
+    lat_min = max(-90.0, lat_min - lat_span)
+    lat_max = min(90.0, lat_max + lat_span)
+    cos_lat = min(
+        math.cos(math.radians(lat_min)), math.cos(math.radians(lat_max)))
+    if lat_max >= 90.0 or lat_min <= -90.0 or cos_lat <= 0:
+      lon_span = 180.0
+    else:
+      lon_span = min(180.0, lat_span / cos_lat)
+
+    (row_min, _) = self._cell(lon_min, lat_min)
+    (row_max, _) = self._cell(lon_min, lat_max)
+    if lon_max - lon_min + 2 * lon_span >= 360.0:
+      columns = range(
+          int(math.floor(-180.0 / self._cell_degrees)),
+          int(math.floor(180.0 / self._cell_degrees)) + 1)
+    else:
+      columns = self._columns(lon_min - lon_span, lon_max + lon_span)
+
+    result = []
+    for row in range(row_min, row_max + 1):
+      for column in columns:
+        result.extend(self._cells.get((row, column), ()))
+    return result
+
+  def _columns(self, lon_min, lon_max):
+    # Wraps around the antimeridian.
+    columns = []
+    for lon_from, lon_to in _split_longitudes(lon_min, lon_max):
+      columns.extend(
+          range(
+              int(math.floor(lon_from / self._cell_degrees)),
+              int(math.floor(lon_to / self._cell_degrees)) + 1))
+    return columns
+
+
+def max_chord_squared(max_distance):
+  """Squared chord between unit vectors max_distance meters apart."""
+  angle = min(max_distance / EARTH_RADIUS_METERS, math.pi)
+  return (2 * math.sin(angle / 2))**2
+
+
+def _split_longitudes(lon_min, lon_max):
+  if lon_min < -180.0:
+    return [(lon_min + 360.0, 180.0), (-180.0, lon_max)]
+  if lon_max > 180.0:
+    return [(lon_min, 180.0), (-180.0, lon_max - 360.0)]
+  return [(lon_min, lon_max)]
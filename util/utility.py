@@ -1,25 +1,59 @@
+import array
 import datetime
 import ephem
+import os
 
 from common import unit
-from onelog.core import models
+from onelog.core import reference
+from onelog.util import cache
 
 
 def get_distance(airport1_code, airport2_code):
 	try:
-		airport1 = models.Airport.objects.get(icao_id=airport1_code)
-		airport2 = models.Airport.objects.get(icao_id=airport2_code)
+		airport1 = reference.get_airport(airport1_code)
+		airport2 = reference.get_airport(airport2_code)
 		return airport1.geolocation - airport2.geolocation
 	except:
 		return None
 
-def get_civil_twilight_time(date, geolocation):
+# Precomputed yearly dawn/dusk tables, written by tools/twilight.py.
+TWILIGHT_TABLE_DIR = '../data/twilight'
+
+# Twilight moves by up to 0.24 seconds per 0.001 degree of longitude, which
+# is below the one-second resolution of the results.
+_TWILIGHT_COORDINATE_PRECISION = 3
+_TWILIGHT_ELEVATION_PRECISION = -2
+
+_twilight_cache = cache.LruCache('civil_twilight', max_size=65536)
+_twilight_tables = cache.LruCache('civil_twilight_table', max_size=1024)
+
+
+def get_civil_twilight_time(date, geolocation, airport=None):
+	"""Returns (dawn, dusk) in UTC following midnight UTC of the given date.
+
+	Uses the precomputed table of the airport when there is one, otherwise
+	solves with ephem on a quantized location and memoizes the result.
+	"""
+	if airport:
+		twilight = _get_civil_twilight_time_from_table(date, airport)
+		if twilight:
+			return twilight
+
+	key = (
+		datetime.date(date.year, date.month, date.day),
+		round(geolocation.latitude.degree, _TWILIGHT_COORDINATE_PRECISION),
+		round(geolocation.longitude.degree, _TWILIGHT_COORDINATE_PRECISION),
+		round(geolocation.elevation.meter, _TWILIGHT_ELEVATION_PRECISION))
+	return _twilight_cache.get(key, lambda x: compute_civil_twilight_time(*x))
+
+
+def compute_civil_twilight_time(date, latitude, longitude, elevation):
 	observer = ephem.Observer()
 	observer.pressure = 0
 	observer.horizon = '-6'
-	observer.lat = str(geolocation.latitude.degree)
-	observer.lon = str(geolocation.longitude.degree)
-	observer.elevation = geolocation.elevation.meter
+	observer.lat = str(latitude)
+	observer.lon = str(longitude)
+	observer.elevation = elevation
 	observer.date = datetime.datetime(date.year, date.month, date.day)
 	sun = ephem.Sun()
 	dawn = observer.next_rising(sun, use_center=True).tuple()
@@ -28,3 +62,60 @@ def get_civil_twilight_time(date, geolocation):
 	dusk = datetime.datetime(dusk[0], dusk[1], dusk[2], dusk[3], dusk[4], int(dusk[5]))
 
 	return (dawn, dusk)
+
+
+def get_civil_twilight_table_path(airport, year):
+	return os.path.join(TWILIGHT_TABLE_DIR, str(year), '{0}.dat'.format(airport))
+
+
+def write_civil_twilight_table(airport, year, geolocation):
+	"""Precomputes dawn/dusk of every day of the year for an airport.
+
+	The table is a flat array of 32-bit ints, two per day of year, holding
+	seconds from midnight UTC to dawn and dusk, or -1 where ephem fails.
+	"""
+	table = array.array('i')
+	date = datetime.date(year, 1, 1)
+	while date.year == year:
+		midnight = datetime.datetime(date.year, date.month, date.day)
+		try:
+			(dawn, dusk) = compute_civil_twilight_time(
+				date,
+				geolocation.latitude.degree,
+				geolocation.longitude.degree,
+				geolocation.elevation.meter)
+			table.append(int((dawn - midnight).total_seconds()))
+			table.append(int((dusk - midnight).total_seconds()))
+		except ephem.CircumpolarError:
+			table.extend([-1, -1])
+		date += datetime.timedelta(days=1)
+
+	path = get_civil_twilight_table_path(airport, year)
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		table.tofile(f)
+	_twilight_tables.invalidate((airport, year))
+
+
+def _load_civil_twilight_table(key):
+	path = get_civil_twilight_table_path(*key)
+	if not os.path.exists(path):
+		return None
+	table = array.array('i')
+	with open(path, 'rb') as f:
+		table.fromfile(f, os.path.getsize(path) // table.itemsize)
+	return table
+
+
+def _get_civil_twilight_time_from_table(date, airport):
+	table = _twilight_tables.get((airport, date.year), _load_civil_twilight_table)
+	if not table:
+		return None
+
+	index = (date.timetuple().tm_yday - 1) * 2
+	if index + 1 >= len(table) or table[index] < 0:
+		return None
+	midnight = datetime.datetime(date.year, date.month, date.day)
+	return (midnight + datetime.timedelta(seconds=table[index]),
+		midnight + datetime.timedelta(seconds=table[index + 1]))